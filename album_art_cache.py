@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# An on-disk cache of album art, so an album that airs again doesn't have to be downloaded again.
+#
+# Files are named by a hash of the normalized art URL. The cache keeps to a byte budget by evicting the
+# least recently used images, and recency survives restarts because a hit touches the file's mtime.
+# Downloads stream straight to disk rather than being held in memory.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+
+# Bytes to read from the network at a time while streaming an image to disk
+download_chunk_size = 65536
+
+# Shared caches, one per directory
+caches = {}
+caches_lock = threading.Lock()
+
+
+# The same image can be linked with different host casing or a #fragment. Those shouldn't be separate entries.
+def normalize_url(url):
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ""))
+
+
+def cache_key(url):
+    return hashlib.sha256(normalize_url(url).encode()).hexdigest()
+
+
+class AlbumArtCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> size in bytes, least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    # Picks up what's already on disk, oldest first, & clears out half-finished downloads
+    def load(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".part"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(files):
+            self.entries[name] = size
+            self.total_bytes += size
+        self.evict()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key)
+
+    # Returns the path of the cached file for this key, or None if we don't have it
+    def lookup(self, key):
+        path = self.path_for(key)
+        with self.lock:
+            if key in self.entries:
+                try:
+                    os.utime(path)
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return path
+                except FileNotFoundError:
+                    # Someone cleaned out the directory under us. Forget it & fetch again.
+                    self.total_bytes -= self.entries.pop(key)
+            self.misses += 1
+        return None
+
+    # A temporary file to write a new entry to before handing it to add()
+    def temp_path(self, key):
+        return f"{self.path_for(key)}.{threading.get_ident()}.part"
+
+    # Moves a finished temporary file into place as the entry for this key & returns its path
+    def add(self, key, temp_path):
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            # Another thread may have stored the same entry while we did
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]
+            self.entries[key] = size
+            self.entries.move_to_end(key)
+            self.total_bytes += size
+            self.evict()
+        return path
+
+    # Returns the path of the cached image for this URL, downloading it first if we don't have it
+    def get(self, url, session, timeout):
+        key = cache_key(url)
+        path = self.lookup(key)
+        if path:
+            return path
+        # Stream to a temporary file & move it into place, so a failed download never leaves a broken entry
+        temp_path = self.temp_path(key)
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                with open(temp_path, 'wb') as file:
+                    for chunk in response.iter_content(chunk_size=download_chunk_size):
+                        if chunk:
+                            file.write(chunk)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return self.add(key, temp_path)
+
+    # Drops least recently used images until we're back under budget. Never evicts the newest one.
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path_for(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "files": len(self.entries), "bytes": self.total_bytes}
+
+
+# Returns the shared cache for this directory, creating it the first time
+def open_cache(directory, max_bytes):
+    with caches_lock:
+        if directory not in caches:
+            caches[directory] = AlbumArtCache(directory, max_bytes)
+        caches[directory].max_bytes = max_bytes
+        return caches[directory]
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+# Finds album art for spins Spinitron has no art for (the loudspeaker.svg placeholder or no image at all).
+#
+# Two services do the work: one maps an (artist, album) to a MusicBrainz release ID (MBID), and one serves the
+# cover for an MBID. Answers are kept in the mbid_cache table, including "not found" (for a while, in case
+# MusicBrainz catches up), so a repeat album never costs another lookup. Lookups start in the background as
+# soon as the poller sees a spin, & the cover is downloaded into the album art cache, so by the time the
+# outbox worker posts the spin the image is usually already on disk.
+
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import metrics
+
+
+# Shared lookups, one per (database, services) combination
+lookups = {}
+lookups_lock = threading.Lock()
+
+
+# Lookups are keyed case- & whitespace-insensitively, so "Kind Of Blue " & "kind of blue" are one entry
+def lookup_key(artist, album):
+    return " ".join(artist.lower().split()), " ".join(album.lower().split())
+
+
+class AlbumArtLookup:
+    # database is a PlaylistDatabase holding the mbid_cache table. art_cache is an AlbumArtCache for the covers,
+    # and get_session returns the calling thread's requests session.
+    def __init__(self, database, art_cache, get_session, mbid_api_url, art_api_url, size=800, workers=2,
+                 negative_ttl=7 * 24 * 3600, timeout=20):
+        self.database = database
+        self.get_session = get_session
+        self.mbid_api_url = mbid_api_url.rstrip("/")
+        self.art_api_url = art_api_url.rstrip("/")
+        self.lock = threading.Lock()
+        # key -> Future for lookups that are running, so the same album is never looked up twice at once
+        self.in_flight = {}
+        self.executor = None
+        self.workers = None
+        self.configure(art_cache, size, workers, negative_ttl, timeout)
+
+    # Applies the settings, including new ones after a config reload. With a different number of workers,
+    # lookups already queued finish on the old threads & new ones go to the new pool.
+    def configure(self, art_cache, size=800, workers=2, negative_ttl=7 * 24 * 3600, timeout=20):
+        self.art_cache = art_cache
+        self.size = size
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        with self.lock:
+            if workers == self.workers:
+                return
+            old_executor = self.executor
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="art-lookup")
+            self.workers = workers
+        if old_executor is not None:
+            old_executor.shutdown(wait=False)
+
+    # Whether we should look for art for this spin at all
+    @staticmethod
+    def wanted(song):
+        return song.get("image_status") == "no image" and song.get("a", "").strip() and song.get("r", "").strip()
+
+    # Starts finding & downloading the cover for a spin in the background, if it needs one
+    def prefetch(self, song):
+        if self.wanted(song):
+            self.start(song["a"], song["r"])
+
+    def start(self, artist, album):
+        key = lookup_key(artist, album)
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self.fetch_cover, artist, album)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda done: self.finished(key, done))
+            return future
+
+    def finished(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    # The local path of the cover for a spin, or None if there isn't one. Waits for a prefetch that's still
+    # running, or does the lookup now if none was started (e.g. the spin was queued before a restart).
+    def image_for(self, song, timeout=None):
+        if not self.wanted(song):
+            return None
+        try:
+            return self.start(song["a"], song["r"]).result(timeout or self.timeout * 2)
+        except TimeoutError:
+            print(f"***** Album art lookup for {song['r']} by {song['a']} is taking too long, posting without it")
+        except Exception as e:
+            print(f"***** Album art lookup for {song['r']} by {song['a']} failed: {e}")
+        return None
+
+    # Resolves the MBID & downloads the cover into the album art cache. Returns its path, or None.
+    def fetch_cover(self, artist, album):
+        with metrics.timer("art_lookup"):
+            mbid = self.resolve(artist, album)
+            if mbid is None:
+                return None
+            return self.art_cache.get(f"{self.art_api_url}/art/{mbid}?size={self.size}", self.get_session(), self.timeout)
+
+    # The MBID for an album, from the cache if we've looked before, or None if it can't be found
+    def resolve(self, artist, album):
+        key = lookup_key(artist, album)
+        cached = self.database.cached_mbid(*key)
+        if cached is not None:
+            mbid, looked_up_at = cached
+            if mbid is not None or time.time() - looked_up_at < self.negative_ttl:
+                metrics.increment("kuvo_art_lookups_total", result="cached")
+                return mbid
+        mbid = self.request_mbid(artist, album)
+        self.database.save_mbid(key[0], key[1], mbid, time.time())
+        metrics.increment("kuvo_art_lookups_total", result="found" if mbid else "not_found")
+        return mbid
+
+    # Asks the MBID service. A 404 or an answer without an MBID means "not found"; anything else that goes
+    # wrong raises, so a network problem isn't remembered as a miss.
+    def request_mbid(self, artist, album):
+        payload = json.dumps({"artist": artist, "album": album}).encode("utf-8")
+        files = {"payload": ("payload.json", payload, "application/json")}
+        response = self.get_session().post(f"{self.mbid_api_url}/mbid", files=files, timeout=self.timeout)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json().get("mbid") or None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Returns the shared lookup for a database & pair of services, creating it the first time. The art cache &
+# options are applied every time, so a config reload's new settings take effect.
+def open_lookup(database, art_cache, get_session, mbid_api_url, art_api_url, **options):
+    key = (database.db_file, mbid_api_url, art_api_url)
+    with lookups_lock:
+        if key not in lookups:
+            lookups[key] = AlbumArtLookup(database, art_cache, get_session, mbid_api_url, art_api_url, **options)
+        else:
+            lookups[key].configure(art_cache, **options)
+        return lookups[key]
+
+
+def close_lookups():
+    with lookups_lock:
+        for lookup in lookups.values():
+            lookup.shutdown()
+        lookups.clear()
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+
+# Offline benchmarks for the bot, one timing per stage, against the local stubs in stub_servers.py.
+#
+#   python benchmarks/bench_kuvo.py --output results.json
+#   python benchmarks/bench_kuvo.py --compare results.json      # run again & compare with an earlier run
+#
+# Results are JSON: for each stage the number of runs and the mean, p50, p99 & max in milliseconds,
+# plus the git revision & Python version they came from.
+#
+# Before timing anything it checks the streaming parser still agrees with BeautifulSoup on every fixture
+# (spinitron_parser.check_parity), & stops with an error if it doesn't: a fast parser that's wrong isn't worth
+# timing.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import functools
+import platform
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import StubServer, fixtures_directory
+import kuvo_playlist_mastodon as poller
+import spinitron_parser
+import playlist_database
+import album_art_cache
+from outbox import OutboxWorker
+import kuvo_playlist_api
+from response_cache import ResponseCache
+
+
+fixture_names = sorted(name[:-5] for name in os.listdir(fixtures_directory) if name.endswith(".html"))
+database_sizes = [1000, 10000, 100000]
+djs = [f"Dj Number {n}" for n in range(20)]
+
+
+# Runs the parser parity check over the fixtures. Returns the mismatches.
+def check_fixture_parity():
+    paths = [os.path.join(fixtures_directory, f"{name}.html") for name in fixture_names]
+    return spinitron_parser.check_parity(paths)
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    count = len(samples)
+    return {
+        "runs": count,
+        "mean_ms": round(sum(samples) / count * 1000, 4),
+        "p50_ms": round(samples[count // 2] * 1000, 4),
+        "p99_ms": round(samples[min(count - 1, int(count * 0.99))] * 1000, 4),
+        "max_ms": round(samples[-1] * 1000, 4),
+    }
+
+
+# Times function() iterations times. setup(), if given, runs untimed before each call & its result is passed in.
+def time_stage(function, iterations, setup=None):
+    samples = []
+    for _ in range(iterations):
+        argument = setup() if setup else None
+        started = time.perf_counter()
+        function(argument) if setup else function()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def fixture_content(name):
+    with open(os.path.join(fixtures_directory, name + ".html"), "rb") as file:
+        return file.read()
+
+
+def bench_scrape(results, stub, iterations):
+    for name in fixture_names:
+        url = f"{stub.base_url}/playlist/{name}"
+        content = fixture_content(name)
+        # A poll that has to download & parse, as after a song change
+        results[f"get_current_song.changed.{name}"] = time_stage(
+            lambda fetch_state: poller.get_current_song(url, "768x768", fetch_state), iterations, setup=dict)
+        # A poll where nothing changed, answered with a 304
+        warm_state = {}
+        poller.get_current_song(url, "768x768", warm_state)
+        results[f"get_current_song.unchanged.{name}"] = time_stage(
+            lambda: poller.get_current_song(url, "768x768", warm_state), iterations)
+        # Parsing alone
+        results[f"parse.fast.{name}"] = time_stage(
+            lambda: spinitron_parser.parse_current_song_fast(content, "768x768"), iterations)
+        results[f"parse.soup.{name}"] = time_stage(
+            lambda: spinitron_parser.parse_current_song_soup(content, "768x768"), iterations)
+        results[f"parse.all_songs.{name}"] = time_stage(
+            lambda: spinitron_parser.parse_all_songs(content, "768x768"), iterations)
+
+
+def all_fixture_songs():
+    songs = []
+    for name in fixture_names:
+        songs.extend(spinitron_parser.parse_all_songs(fixture_content(name), "768x768"))
+    return songs
+
+
+def bench_hashtags(results, songs, iterations):
+    results["make_hashtags"] = time_stage(
+        lambda: [poller.make_hashtags(song["a"], song["s"], song["dj"], "#KUVO #Jazz") for song in songs], iterations)
+    results["make_hashtags"]["songs_per_run"] = len(songs)
+    results["clean_string"] = time_stage(lambda: [poller.clean_string(song["a"]) for song in songs], iterations)
+
+
+def bench_write_database(results, songs, directory, iterations):
+    db_file = os.path.join(directory, "write.db")
+    counter = iter(range(10 ** 9))
+
+    def next_song():
+        song = dict(random.choice(songs))
+        song["i"] = f"bench-{next(counter)}"
+        return song
+
+    # The first write opens & migrates the database, so time it on its own
+    results["write_database.first"] = time_stage(lambda song: poller.write_database(song, db_file), 1, setup=next_song)
+    results["write_database"] = time_stage(lambda song: poller.write_database(song, db_file), iterations, setup=next_song)
+    results["write_database.with_outbox"] = time_stage(
+        lambda song: poller.write_database(song, db_file, post=True), iterations, setup=next_song)
+
+
+def bench_art_and_posting(results, stub, directory, iterations):
+    cache = album_art_cache.AlbumArtCache(os.path.join(directory, "art"), 1024 * 1024 * 1024)
+    session = poller.get_http_session()
+    counter = iter(range(10 ** 9))
+    results["album_art.miss"] = time_stage(
+        lambda url: cache.get(url, session, 10), iterations, setup=lambda: f"{stub.base_url}/art/{next(counter)}.jpg")
+    hit_url = f"{stub.base_url}/art/hit.jpg"
+    cache.get(hit_url, session, 10)
+    results["album_art.hit"] = time_stage(lambda: cache.get(hit_url, session, 10), iterations)
+
+    mastodon = poller.get_mastodon_client(stub.base_url, "bench-token")
+    image_path = cache.get(hit_url, session, 10)
+
+    def media_post():
+        with open(image_path, "rb") as image_file:
+            mastodon.media_post(image_file, mime_type="image/jpeg", description="bench")
+
+    results["mastodon.media_post"] = time_stage(media_post, iterations)
+    results["mastodon.status_post"] = time_stage(
+        lambda: mastodon.status_post(status="bench", visibility="public"), iterations)
+
+
+# One spin posted to three destinations whose instances take 20, 40 & 60 ms a request, through the outbox
+# worker (all at once) & one after another. The worker should take about as long as the slowest one.
+def bench_fanout(results, stub, directory, iterations):
+    instances = [StubServer().start() for _ in range(3)]
+    try:
+        for delay, instance in zip((0.02, 0.04, 0.06), instances):
+            instance.mastodon_delay = delay
+        config = {"playlist_url": f"{stub.base_url}/playlist/playlist_midday", "album_art_size": "768x768",
+                  "database": "fanout.db", "hashtags": "#KUVO", "times_to_poll_per_minute": 3,
+                  "album_art_cache_dir": "art",
+                  "destinations": [{"name": f"instance{n}", "mastodon_server": instance.base_url,
+                                    "mastodon_access_token": "bench-token"} for n, instance in enumerate(instances)]}
+        station = poller.Station("fanout", config, directory)
+        worker = OutboxWorker(station.name, playlist_database.open_database(station.database),
+                              functools.partial(poller.prepare_station_post, station),
+                              functools.partial(poller.send_station_post, station),
+                              functools.partial(poller.destination_client, station))
+        counter = iter(range(10 ** 9))
+        songs = all_fixture_songs()
+
+        def queue_song():
+            song = dict(random.choice(songs), i=f"fanout-{next(counter)}", image_status="image",
+                        image=f"{stub.base_url}/art/fanout.jpg")
+            poller.write_database(song, station.database, post=True,
+                                  destinations=functools.partial(poller.song_destinations, station))
+            return song
+
+        # Warm up the clients & the art cache so the stages only time posting
+        queue_song()
+        worker.drain()
+        results["post.fanout_3.concurrent"] = time_stage(lambda song: worker.drain(), iterations, setup=queue_song)
+
+        def post_one_by_one(song):
+            prepared = poller.prepare_station_post(station, song)
+            for name in poller.station_destinations(config):
+                poller.send_station_post(station, prepared, name)
+
+        results["post.fanout_3.sequential"] = time_stage(post_one_by_one, iterations, setup=queue_song)
+    finally:
+        for instance in instances:
+            instance.stop()
+
+
+# Builds a database of `size` spins, one every five minutes back from now (then scattered over the last year),
+# with the DJ changing every three hours
+def build_database(db_file, size):
+    database = playlist_database.open_database(db_file)
+    now = datetime.now()
+    rows = []
+    for n in range(size):
+        played_at = now - timedelta(minutes=5 * n)
+        if played_at < now - timedelta(days=365):
+            played_at = now - timedelta(days=random.uniform(1, 365))
+        rows.append((played_at.isoformat(" "), f"seed-{n}", djs[(n // 36) % len(djs)], f"Song {n}",
+                     f"Artist {n % 3000}", f"Album {n % 5000}", ""))
+    with database.transaction() as conn:
+        conn.executemany('''INSERT INTO playlist (datetime_column, playlist_id, dj, song, artist, album, album_art)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+    return database
+
+
+# The size stages run with the response cache off, so every request reads the database. The cached stage then
+# times a repeated request on the largest database, answered from memory.
+def bench_api(results, directory, iterations):
+    client = kuvo_playlist_api.app.test_client()
+    dj = djs[0]
+    response_cache = kuvo_playlist_api.response_cache
+    kuvo_playlist_api.response_cache = ResponseCache(0)
+    try:
+        for size in database_sizes:
+            db_file = os.path.join(directory, f"api_{size}.db")
+            build_database(db_file, size)
+            kuvo_playlist_api.DB_PATH = db_file
+            results[f"songs_by_dj.{size}_rows"] = time_stage(
+                lambda: client.get("/songs_by_dj", query_string={"dj": dj}), iterations)
+        kuvo_playlist_api.response_cache = ResponseCache()
+        client.get("/songs_by_dj", query_string={"dj": dj})
+        results[f"songs_by_dj.{database_sizes[-1]}_rows.cached"] = time_stage(
+            lambda: client.get("/songs_by_dj", query_string={"dj": dj}), iterations)
+    finally:
+        kuvo_playlist_api.response_cache = response_cache
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# Prints how each stage's p50 moved compared with an earlier results file
+def compare(previous, current):
+    print(f"{'stage':55} {'before p50':>12} {'after p50':>12} {'change':>8}")
+    for stage, result in current["results"].items():
+        before = previous["results"].get(stage)
+        if not before:
+            print(f"{stage:55} {'-':>12} {result['p50_ms']:>12.3f} {'new':>8}")
+            continue
+        change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0
+        print(f"{stage:55} {before['p50_ms']:>12.3f} {result['p50_ms']:>12.3f} {change:>+7.1f}%")
+
+
+# Runs every stage & returns the report
+def run_benchmarks(args):
+    if check_fixture_parity():
+        sys.exit("The streaming parser disagrees with BeautifulSoup on a fixture, see above")
+    random.seed(1)
+    directory = tempfile.mkdtemp(prefix="kuvo_bench_")
+    poller.working_directory = directory
+    stub = StubServer().start()
+    results = {}
+    try:
+        bench_scrape(results, stub, args.iterations)
+        songs = all_fixture_songs()
+        bench_hashtags(results, songs, args.iterations)
+        bench_write_database(results, songs, directory, args.iterations)
+        bench_art_and_posting(results, stub, directory, args.iterations)
+        bench_fanout(results, stub, directory, args.iterations)
+        if not args.skip_api:
+            bench_api(results, directory, args.iterations)
+    finally:
+        stub.stop()
+        playlist_database.close_databases()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "iterations": args.iterations,
+        "parser_parity": f"{len(fixture_names)} fixtures ok",
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's stages against local stub servers.")
+    parser.add_argument("--iterations", type=int, default=50, help="Runs per stage")
+    parser.add_argument("--output", help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--compare", help="An earlier results file to compare this run with")
+    parser.add_argument("--skip-api", action="store_true", help="Skip the /songs_by_dj stages, which build large databases")
+    args = parser.parse_args()
+
+    # Stdout is only the JSON report, so it can be piped to jq. Everything the bot logs while it's benchmarked,
+    # & the comparison table, goes to stderr.
+    stdout = sys.stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmarks(args)
+        output = json.dumps(report, indent=2)
+        print(output, file=stdout)
+        if args.output:
+            with open(args.output, "w") as file:
+                file.write(output + "\n")
+        if args.compare:
+            with open(args.compare) as file:
+                compare(json.load(file), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# Checks what the poller costs to start, against a budget, using python -X importtime.
+#
+#   python benchmarks/import_time.py
+#   python benchmarks/import_time.py --budget-ms 600 --runs 10      # e.g. on the Pi
+#
+# Two measurements, each in fresh interpreters so nothing is already imported:
+#   import     importing kuvo_playlist_mastodon, with the modules that cost the most
+#   no_change  a whole cron run that finds the same song still playing, against the stub server: wall time,
+#              peak RSS, & which modules it imported
+# Neither may load what only storing or posting a song needs (Mastodon.py, unidecode, sqlite3, Pillow,
+# BeautifulSoup). Exits 1 if one does, or if the median import takes longer than the budget.
+
+import os
+import re
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import StubServer
+
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules the poller should only import once it has a song to store or post
+lazy_modules = ["mastodon", "unidecode", "sqlite3", "playlist_database", "PIL", "bs4"]
+
+
+# Parses -X importtime output into (module, depth, self microseconds, cumulative microseconds), one per import.
+# A module's own imports come just before it, one level deeper.
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return imports
+
+
+# The modules a module imported itself, with their cumulative times
+def imported_by(imports, module):
+    position = next(index for index, entry in enumerate(imports) if entry[0] == module)
+    depth = imports[position][1]
+    children = []
+    for name, child_depth, _, cumulative in reversed(imports[:position]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            children.append((name, cumulative))
+    return children
+
+
+def eagerly_loaded(imports):
+    return sorted({lazy for lazy in lazy_modules for name, _, _, _ in imports
+                   if name == lazy or name.startswith(lazy + ".")})
+
+
+# Runs python -X importtime with these arguments. Returns the imports, the wall time & the peak RSS in KB.
+def run_python(arguments, cwd):
+    process = subprocess.Popen([sys.executable, "-X", "importtime"] + arguments, cwd=cwd,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    started = os.times().elapsed
+    stderr = process.stderr.read()
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = os.times().elapsed - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.exit(f"{' '.join(arguments)} failed:\n{stderr}")
+    return parse_importtime(stderr), elapsed, usage.ru_maxrss
+
+
+def measure_import(runs, top):
+    totals = []
+    for _ in range(runs):
+        imports, _, _ = run_python(["-c", "import kuvo_playlist_mastodon"], repository)
+        totals.append(next(cumulative for name, _, _, cumulative in imports if name == "kuvo_playlist_mastodon"))
+    heaviest = sorted(imported_by(imports, "kuvo_playlist_mastodon"), key=lambda child: child[1], reverse=True)
+    return {
+        "median_ms": round(statistics.median(totals) / 1000, 1),
+        "min_ms": round(min(totals) / 1000, 1),
+        "heaviest_ms": {name: round(cumulative / 1000, 1) for name, cumulative in heaviest[:top]},
+        "eagerly_loaded": eagerly_loaded(imports),
+    }
+
+
+# A cron run against the stub server. The first run posts the song on the page; the ones after it find it unchanged.
+def measure_no_change(runs):
+    stub = StubServer().start()
+    # Point the covers at the stub too, so the first run's post succeeds & leaves nothing queued
+    page = re.sub(rb'https://[^"]+\.jpg', f"{stub.base_url}/art/cover.jpg".encode(), stub.page("playlist_midday"))
+    stub.set_page("playlist_midday", page)
+    directory = tempfile.mkdtemp(prefix="kuvo_import_time_")
+    os.makedirs(os.path.join(directory, "config"))
+    config = {"playlist_url": f"{stub.base_url}/playlist/playlist_midday", "album_art_size": "768x768",
+              "times_to_poll_per_minute": 2, "hashtags": "#KUVO", "database": "playlist.db",
+              "mastodon_server": stub.base_url, "mastodon_access_token": "bench"}
+    with open(os.path.join(directory, "config", "config.json"), "w") as file:
+        json.dump(config, file)
+    script = os.path.join(repository, "kuvo_playlist_mastodon.py")
+    try:
+        run_python([script, directory], repository)
+        results = [run_python([script, directory], repository) for _ in range(runs)]
+    finally:
+        stub.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        "median_wall_ms": round(statistics.median(elapsed for _, elapsed, _ in results) * 1000, 1),
+        "peak_rss_kb": max(rss for _, _, rss in results),
+        "modules_imported": len(results[-1][0]),
+        "eagerly_loaded": sorted({name for imports, _, _ in results for name in eagerly_loaded(imports)}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the poller's import time & no-change cron run against a budget.")
+    parser.add_argument("--budget-ms", type=float, default=250, help="Most the median import of the poller may take")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=10, help="How many of the most expensive imports to list")
+    args = parser.parse_args()
+
+    report = {"budget_ms": args.budget_ms, "import": measure_import(args.runs, args.top),
+              "no_change": measure_no_change(args.runs)}
+    print(json.dumps(report, indent=2))
+    failures = []
+    if report["import"]["median_ms"] > args.budget_ms:
+        failures.append(f"importing the poller took {report['import']['median_ms']} ms, over the {args.budget_ms} ms budget")
+    for measurement in ("import", "no_change"):
+        if report[measurement]["eagerly_loaded"]:
+            failures.append(f"{measurement} loaded {', '.join(report[measurement]['eagerly_loaded'])}")
+    for failure in failures:
+        print(f"***** Over budget: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
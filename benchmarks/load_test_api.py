@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+# Load test for the playlist API as it runs in production: gunicorn with gthread workers (gunicorn.conf.py),
+# against a generated database, with many clients on keep-alive connections hitting /songs_by_dj.
+#
+#   python benchmarks/load_test_api.py --rows 100000 --workers 2 --threads 16 --concurrency 32
+#
+# It runs twice, with the response cache on & off (KUVO_API_CACHE_ENTRIES=0), & reports p50/p99 latency and
+# requests per second for each, as JSON. A third run holds --streams idle /now_playing/stream subscribers open
+# the whole time, to check listeners can't take the threads the JSON routes need, & reports how many were
+# turned away with a 503.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_kuvo import build_database, summarize, djs
+import playlist_database
+
+
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Starts gunicorn with the repo's config & waits until it answers
+def start_server(db_file, port, workers, threads, cache_entries):
+    env = dict(os.environ, KUVO_DB_PATH=db_file, KUVO_API_BIND=f"127.0.0.1:{port}", KUVO_API_WORKERS=str(workers),
+               KUVO_API_THREADS=str(threads), KUVO_API_CACHE_ENTRIES=str(cache_entries))
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "kuvo_playlist_api:app"],
+                              cwd=repository_directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/songs_by_dj?dj=" + quote(djs[0]))
+            conn.getresponse().read()
+            conn.close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("gunicorn didn't start")
+
+
+# Each client thread keeps one connection open & sends requests for random DJs until the total is reached
+def run_clients(port, concurrency, total_requests):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    remaining = [total_requests]
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        samples = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            path = "/songs_by_dj?dj=" + quote(random.choice(djs))
+            started = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    errors.append(response.status)
+            except (OSError, http.client.HTTPException) as e:
+                errors.append(str(e))
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            samples.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(samples)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    result = summarize(latencies)
+    result["requests_per_second"] = round(len(latencies) / elapsed, 1)
+    result["errors"] = len(errors)
+    return result
+
+
+# Opens count SSE subscriptions & leaves them idle. Returns the open connections & how many got a 503.
+def open_streams(port, count):
+    streams = []
+    refused = 0
+    for _ in range(count):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        conn.request("GET", "/now_playing/stream")
+        response = conn.getresponse()
+        if response.status == 200:
+            streams.append(conn)
+        else:
+            response.read()
+            conn.close()
+            refused += 1
+    return streams, refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /songs_by_dj under gunicorn against a generated database.")
+    parser.add_argument("--rows", type=int, default=100000, help="Spins in the generated database")
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=16, help="Threads per worker")
+    parser.add_argument("--concurrency", type=int, default=32, help="Client connections")
+    parser.add_argument("--requests", type=int, default=5000, help="Requests per run")
+    parser.add_argument("--streams", type=int, default=64, help="Idle /now_playing/stream subscribers for the last run")
+    parser.add_argument("--database", help="Use (or build & keep) this database instead of a temporary one")
+    args = parser.parse_args()
+
+    random.seed(1)
+    directory = tempfile.mkdtemp(prefix="kuvo_load_")
+    db_file = os.path.abspath(args.database or os.path.join(directory, "playlist.db"))
+    try:
+        if not os.path.exists(db_file):
+            build_database(db_file, args.rows)
+            playlist_database.close_databases()
+        report = {"rows": args.rows, "workers": args.workers, "threads": args.threads,
+                  "concurrency": args.concurrency, "results": {}}
+        for name, cache_entries in (("cached", 256), ("uncached", 0)):
+            port = free_port()
+            server = start_server(db_file, port, args.workers, args.threads, cache_entries)
+            try:
+                report["results"][f"songs_by_dj.{name}"] = run_clients(port, args.concurrency, args.requests)
+            finally:
+                server.terminate()
+                server.wait(30)
+        if args.streams:
+            port = free_port()
+            server = start_server(db_file, port, args.workers, args.threads, 256)
+            streams = []
+            try:
+                streams, refused = open_streams(port, args.streams)
+                result = run_clients(port, args.concurrency, args.requests)
+                result["streams_open"] = len(streams)
+                result["streams_refused"] = refused
+                report["results"]["songs_by_dj.with_streams"] = result
+            finally:
+                for conn in streams:
+                    conn.close()
+                server.terminate()
+                server.wait(30)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
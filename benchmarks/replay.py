@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+# Replays recorded playlist pages (see page_recorder.py & "record_pages_dir") through the real poller:
+# get_current_song, orchestration_function, the database & the outbox worker, posting to a stub Mastodon.
+#
+#   python benchmarks/replay.py recordings/kuvo-2024-05-0*.jsonl.gz --speed 0
+#   python benchmarks/replay.py recordings/kuvo-2024-05-01.jsonl.gz --poll-seconds 60 --backfill post
+#
+# Time is virtual: the poller's clock is set to each recorded fetch time, so spins get the times they had on air,
+# & nothing sleeps unless --speed asks for it (60 plays an hour in a minute; 0, the default, goes flat out).
+# With --poll-seconds the recording is resampled, polling every that many virtual seconds & seeing whatever
+# page was current then, to try out a different poll interval on a real day.
+#
+# The stub server plays Spinitron, serving each recorded page in turn, & Mastodon. The database is in memory.
+# It reports JSON: pages per second, the posts that would have been made, spins on the pages that never made it
+# into the database, spins that were on top of the page but never posted, & any spin posted twice.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+import tempfile
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_servers import StubServer
+import kuvo_playlist_mastodon as poller
+import playlist_database
+from outbox import OutboxWorker
+from page_recorder import read_recordings
+from spinitron_parser import parse_all_songs
+
+
+class VirtualClock:
+    # speed is how many virtual seconds pass per real one, or 0 to never really wait
+    def __init__(self, start, speed=0):
+        self.now = start
+        self.speed = speed
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if self.speed:
+            time.sleep(seconds / self.speed)
+        self.now += seconds
+
+    def advance_to(self, moment):
+        if moment > self.now:
+            self.sleep(moment - self.now)
+
+
+# Hands every post the same local image, so replays never download art from the real hosts
+class ReplayArtCache:
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, url, session, timeout):
+        return self.path
+
+
+# The fetches to replay: the recording as is, or with --poll-seconds one every that many seconds, each seeing
+# the newest page recorded by then
+def polls(entries, poll_seconds=None):
+    entries = [entry for entry in entries if entry["status"] in (200, 304)]
+    if not poll_seconds:
+        return entries
+    resampled = []
+    current = None
+    position = 0
+    moment = entries[0]["t"]
+    while moment <= entries[-1]["t"]:
+        while position < len(entries) and entries[position]["t"] <= moment:
+            if "content" in entries[position]:
+                current = entries[position]
+            position += 1
+        if current is not None:
+            resampled.append(dict(current, t=moment))
+        moment += poll_seconds
+    return resampled
+
+
+# What the pages themselves say happened: every spin on any of them, the ones that made it to the top, & how
+# often the DJ changed
+def ground_truth(entries, album_art_size):
+    seen = set()
+    on_top = []
+    shift_changes = 0
+    last_dj = None
+    last_sha1 = None
+    for entry in entries:
+        if "content" not in entry or entry["sha1"] == last_sha1:
+            continue
+        last_sha1 = entry["sha1"]
+        songs = [song for song in parse_all_songs(entry["content"], album_art_size) if song["i"] != "notfound"]
+        if not songs:
+            continue
+        seen.update(song["i"] for song in songs)
+        if not on_top or on_top[-1] != songs[0]["i"]:
+            on_top.append(songs[0]["i"])
+        if last_dj is not None and songs[0]["dj"] != last_dj:
+            shift_changes += 1
+        last_dj = songs[0]["dj"]
+    return seen, on_top, shift_changes
+
+
+def replay(entries, args):
+    stub = StubServer().start()
+    directory = tempfile.mkdtemp(prefix="kuvo_replay_")
+    clock = poller.clock = VirtualClock(entries[0]["t"], args.speed)
+    poller.working_directory = directory
+    art_path = os.path.join(directory, "cover.jpg")
+    with open(art_path, "wb") as file:
+        file.write(stub.art)
+    config = {"playlist_url": f"{stub.base_url}/playlist/replay", "album_art_size": args.album_art_size,
+              "times_to_poll_per_minute": 3, "backfill": args.backfill, "hashtags": "#KUVO",
+              "database": "playlist.db", "mastodon_server": stub.base_url, "mastodon_access_token": "replay"}
+    station = poller.Station("replay", config, directory)
+    # Nothing to keep, so skip the disk
+    station.database = ":memory:"
+    database = playlist_database.open_database(station.database)
+    art_cache = ReplayArtCache(art_path)
+    stub_client = poller.get_mastodon_client(stub.base_url, "replay")
+    worker = OutboxWorker(station.name, database,
+                          lambda song: poller.prepare_post(song, config["hashtags"], art_cache),
+                          lambda prepared, destination: poller.send_post(prepared, stub_client),
+                          lambda destination: stub_client)
+    # Drained by hand after each poll rather than run as a thread, so the poller doesn't start its own
+    station.outbox_worker = worker
+    try:
+        started = time.perf_counter()
+        for entry in entries:
+            clock.advance_to(entry["t"])
+            if "content" in entry:
+                stub.set_page("replay", entry["content"])
+            poller.poll_station(station)
+            worker.drain()
+        elapsed = time.perf_counter() - started
+        stored = {row[0] for row in database.conn.execute("SELECT playlist_id FROM playlist")}
+        posted = {row[0] for row in database.conn.execute("SELECT playlist_id FROM outbox WHERE status = 'posted'")}
+        statuses = list(stub.statuses)
+    finally:
+        stub.stop()
+        playlist_database.close_databases()
+        poller.clock = time
+        shutil.rmtree(directory, ignore_errors=True)
+    return elapsed, stored, posted, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded playlist pages through the poller on a virtual clock.")
+    parser.add_argument("recordings", nargs="+", help="Recorded .jsonl.gz files, read together in time order")
+    parser.add_argument("--speed", type=float, default=0, help="Virtual seconds per real second (0 for as fast as possible)")
+    parser.add_argument("--poll-seconds", type=float, help="Poll every this many seconds instead of when the recording did")
+    parser.add_argument("--backfill", default="archive", choices=("archive", "post", "off"), help="The poller's backfill setting")
+    parser.add_argument("--verbose", action="store_true", help="Show the poller's log lines")
+    parser.add_argument("--album-art-size", default="768x768", help="The poller's album_art_size")
+    args = parser.parse_args()
+
+    entries = polls(read_recordings(args.recordings), args.poll_seconds)
+    if not entries:
+        sys.exit("Nothing to replay")
+    # The poller logs every poll & post. Keep them out of the report unless asked for.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        seen, on_top, shift_changes = ground_truth(entries, args.album_art_size)
+        elapsed, stored, posted, statuses = replay(entries, args)
+    duplicates = {status: count for status, count in Counter(statuses).items() if count > 1}
+    report = {
+        "pages": len(entries),
+        "virtual_hours": round((entries[-1]["t"] - entries[0]["t"]) / 3600, 2),
+        "elapsed_seconds": round(elapsed, 3),
+        "pages_per_second": round(len(entries) / elapsed, 1) if elapsed else None,
+        "shift_changes": shift_changes,
+        "spins_on_pages": len(seen),
+        "spins_stored": len(stored & seen),
+        "missed_spins": sorted(seen - stored),
+        "posts": len(statuses),
+        "unposted_spins": [spin for spin in on_top if spin not in posted],
+        "duplicate_posts": duplicates,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+# Local stand-ins for Spinitron & Mastodon, so the bot can be benchmarked (or poked at) without touching
+# KUVO's live playlist or a real Mastodon instance.
+#
+# One threaded HTTP server answers:
+#   GET  /playlist/<name>     a recorded playlist page from benchmarks/fixtures/<name>.html, with an ETag
+#   GET  /art/<anything>      a fixed-size fake JPEG, for Spinitron's art or the cover art service
+#   POST /mbid                the MBID lookup service: a made-up MBID, or 404 for the artist "Unknown Artist"
+#   POST /api/v2/media        a Mastodon media upload
+#   POST /api/v1/statuses     a Mastodon status post
+#   GET  /api/v1/instance     enough of an instance for Mastodon.py
+#
+# Run it on its own to point a real config at it:
+#   python benchmarks/stub_servers.py 8080
+
+import os
+import sys
+import json
+import uuid
+import hashlib
+import time
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+fixtures_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# Size of the fake album art. Roughly what a 768x768 JPEG from Spinitron weighs.
+art_bytes = 120 * 1024
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers & body go out in separate writes. Without this, Nagle's algorithm adds ~40ms to every response.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj):
+        # Plenty of rate limit left, resetting far in the future
+        self.send_body(200, json.dumps(obj).encode(), "application/json", {
+            "X-RateLimit-Limit": "300",
+            "X-RateLimit-Remaining": "299",
+            "X-RateLimit-Reset": "2099-01-01T00:00:00.000Z",
+        })
+
+    def do_GET(self):
+        self.server.count(self.path)
+        if self.path.startswith("/playlist/"):
+            page = self.server.page(self.path[len("/playlist/"):])
+            if page is None:
+                self.send_body(404, b"not found", "text/plain")
+                return
+            etag = '"' + hashlib.sha1(page).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_body(200, page, "text/html; charset=utf-8", {"ETag": etag})
+        elif self.path.startswith("/art/"):
+            self.send_body(200, self.server.art, "image/jpeg")
+        elif self.path.startswith("/api/v1/instance"):
+            self.send_json({"uri": "stub.local", "title": "Stub", "version": "4.2.0"})
+        else:
+            self.send_body(404, b"not found", "text/plain")
+
+    def do_POST(self):
+        self.server.count(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile_body = self.rfile.read(length)
+        if self.path.startswith("/api/"):
+            # Stands in for a slow uplink or a busy instance
+            time.sleep(self.server.mastodon_delay)
+        if self.path.startswith("/mbid"):
+            # The payload is a JSON file in a multipart form. A stub can just pick the JSON out of the body.
+            body = self.rfile_body
+            query = json.loads(body[body.index(b"{"):body.rindex(b"}") + 1])
+            if query.get("artist") == "Unknown Artist":
+                self.send_body(404, b'{"error": "not found"}', "application/json")
+            else:
+                key = f"{query.get('artist')}|{query.get('album')}".lower().encode()
+                self.send_json({"mbid": str(uuid.UUID(hashlib.md5(key).hexdigest()))})
+        elif self.path.startswith("/api/v2/media"):
+            self.send_json({"id": str(self.server.next_id()), "type": "image", "url": "http://stub.local/media.jpg"})
+        elif self.path.startswith("/api/v1/statuses"):
+            self.server.add_status(self.rfile_body, self.headers.get("Content-Type", ""))
+            self.send_json({"id": str(self.server.next_id()), "content": "", "created_at": "2024-01-01T00:00:00.000Z"})
+        else:
+            self.send_body(404, b"not found", "text/plain")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.ids = 0
+        self.pages = {}
+        self.art = b"\xff\xd8\xff\xe0" + os.urandom(art_bytes - 6) + b"\xff\xd9"
+        # Seconds each Mastodon API request takes
+        self.mastodon_delay = 0
+        # The text of every status posted, in order
+        self.statuses = []
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    # Pages can be swapped in by tests & benchmarks; otherwise they come from the fixtures directory
+    def set_page(self, name, content):
+        with self.lock:
+            self.pages[name] = content
+
+    def page(self, name):
+        with self.lock:
+            if name in self.pages:
+                return self.pages[name]
+        path = os.path.join(fixtures_directory, os.path.basename(name) + ".html")
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as file:
+            return file.read()
+
+    def count(self, path):
+        with self.lock:
+            key = path.split("?")[0]
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def add_status(self, body, content_type):
+        if content_type.startswith("application/json"):
+            status = json.loads(body).get("status")
+        else:
+            status = parse_qs(body.decode("utf-8")).get("status", [None])[0]
+        with self.lock:
+            self.statuses.append(status)
+
+    def next_id(self):
+        with self.lock:
+            self.ids += 1
+            return self.ids
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = StubServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+    print(f"Stub Spinitron & Mastodon on {server.base_url}")
+    server.serve_forever()
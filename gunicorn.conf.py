@@ -0,0 +1,25 @@
+# Production settings for the playlist API:
+#   KUVO_DB_PATH=/home/pi/kuvo_playlist_mastodon/playlist.db gunicorn -c gunicorn.conf.py kuvo_playlist_api:app
+#
+# gthread workers: a few processes, each with a pool of threads. Every thread keeps its own read-only SQLite
+# connection open between requests, & each process has its own response cache & now-playing watcher.
+# Send SIGHUP to the master to reload the code & config gracefully: new workers start before the old ones
+# finish their requests & exit.
+#
+# Each /now_playing/stream subscriber holds a thread for as long as it's connected. At most half of each worker's
+# threads go to them (KUVO_API_MAX_STREAMS to change it) & the rest get a 503, so listeners can't starve the
+# other routes. Size KUVO_API_WORKERS & KUVO_API_THREADS for your listeners as well as your request rate.
+
+import os
+import multiprocessing
+
+bind = os.environ.get("KUVO_API_BIND", "0.0.0.0:5000")
+worker_class = "gthread"
+workers = int(os.environ.get("KUVO_API_WORKERS", min(multiprocessing.cpu_count(), 4)))
+threads = int(os.environ.get("KUVO_API_THREADS", 16))
+# Long enough for a big /export. Idle SSE streams aren't affected, since gthread workers heartbeat on their own.
+timeout = int(os.environ.get("KUVO_API_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.environ.get("KUVO_API_ACCESS_LOG")
+errorlog = "-"
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+
+# Shrinks album art before it's uploaded to Mastodon.
+#
+# Spinitron's covers are large, often progressive JPEGs with EXIF & colour profiles, and over a slow uplink
+# the upload (plus the instance reprocessing it) is most of a post's latency. Each cover is decoded, scaled down
+# to fit "image_size" pixels, & re-encoded as JPEG or WebP without metadata, lowering the quality until it fits
+# in "image_max_bytes". Variants are kept on disk, named by a hash of the source image & the settings, in a
+# byte-budgeted cache like the album art cache, so a replayed album is only transcoded once.
+#
+# Pillow is optional, & only imported the first time a cover is transcoded, so polls that post nothing never load
+# it. Without it, or for an image it can't decode, the original is uploaded as before.
+
+import io
+import time
+import hashlib
+import functools
+import threading
+import metrics
+
+
+# Never go below this quality to fit the byte limit. A bigger file beats a smeared cover.
+min_quality = 40
+quality_step = 10
+
+# Shared variant makers, one per cache directory & settings
+variant_makers = {}
+variant_makers_lock = threading.Lock()
+
+
+# Pillow's Image & ImageOps modules, or (None, None) if it isn't installed
+@functools.cache
+def load_pillow():
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None, None
+    return Image, ImageOps
+
+
+# The mime type of an image file from its first bytes. Spinitron serves JPEGs, but not always.
+def sniff_mime_type(path):
+    with open(path, 'rb') as file:
+        head = file.read(12)
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head.startswith(b"GIF8"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageVariants:
+    # store is an AlbumArtCache for the variants. image_format is "jpeg" or "webp", size the longest side in
+    # pixels, & max_bytes the size to squeeze each variant under (0 for no limit).
+    def __init__(self, store, image_format="jpeg", size=640, quality=82, max_bytes=0):
+        self.store = store
+        self.image_format = image_format.upper()
+        self.size = size
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.settings = f"{self.image_format}-{size}-{quality}-{max_bytes}"
+        self.lock = threading.Lock()
+        self.transcoded = 0
+        self.reused = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    # The image to upload for the cover at `path`, as (path, mime type). Falls back to the original.
+    def variant_for(self, path):
+        if load_pillow()[0] is None:
+            return path, sniff_mime_type(path)
+        key = hashlib.sha256(f"{file_hash(path)}-{self.settings}".encode()).hexdigest()
+        variant_path = self.store.lookup(key)
+        if variant_path:
+            with self.lock:
+                self.reused += 1
+            return variant_path, sniff_mime_type(variant_path)
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as file:
+                source = file.read()
+            encoded = self.transcode(source)
+        except Exception as e:
+            print(f"***** Couldn't transcode {path}, uploading the original: {e}")
+            return path, sniff_mime_type(path)
+        # Re-encoding an already small image can make it bigger. Then the original is the better upload.
+        if len(encoded) >= len(source):
+            encoded = source
+        temp_path = self.store.temp_path(key)
+        with open(temp_path, 'wb') as file:
+            file.write(encoded)
+        variant_path = self.store.add(key, temp_path)
+        elapsed = time.perf_counter() - started
+        self.record(len(source), len(encoded), elapsed)
+        print(f"***** Transcoded cover: {len(source) // 1024} KB -> {len(encoded) // 1024} KB in {elapsed * 1000:.0f} ms")
+        return variant_path, sniff_mime_type(variant_path)
+
+    # Decodes, scales & re-encodes an image, returning the new bytes
+    def transcode(self, source):
+        Image, ImageOps = load_pillow()
+        with Image.open(io.BytesIO(source)) as image:
+            image.draft("RGB", (self.size, self.size))
+            # The EXIF orientation is about to be dropped, so apply it to the pixels first
+            image = ImageOps.exif_transpose(image)
+            image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+            image.thumbnail((self.size, self.size), Image.LANCZOS)
+            if image.mode == "RGBA" and self.image_format == "JPEG":
+                # JPEG has no transparency, so flatten onto white rather than black
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+        quality = self.quality
+        while True:
+            # Nothing is carried over from the source: no EXIF, XMP or colour profile
+            output = io.BytesIO()
+            if self.image_format == "JPEG":
+                image.save(output, "JPEG", quality=quality, optimize=True, progressive=False)
+            else:
+                image.save(output, "WEBP", quality=quality, method=4)
+            if not self.max_bytes or output.tell() <= self.max_bytes or quality - quality_step < min_quality:
+                return output.getvalue()
+            quality -= quality_step
+
+    def record(self, bytes_in, bytes_out, seconds):
+        with self.lock:
+            self.transcoded += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.seconds += seconds
+        metrics.increment("kuvo_image_bytes_saved_total", bytes_in - bytes_out)
+        metrics.observe("kuvo_stage_seconds", seconds, stage="image_transcode")
+
+    def stats(self):
+        with self.lock:
+            return {"transcoded": self.transcoded, "reused": self.reused, "bytes_in": self.bytes_in,
+                    "bytes_out": self.bytes_out, "bytes_saved": self.bytes_in - self.bytes_out,
+                    "seconds": round(self.seconds, 3)}
+
+
+# Returns the shared variant maker for a store & settings, creating it the first time
+def open_variants(store, **settings):
+    key = (store.directory, tuple(sorted(settings.items())))
+    with variant_makers_lock:
+        if key not in variant_makers:
+            variant_makers[key] = ImageVariants(store, **settings)
+        return variant_makers[key]
@@ -1,11 +1,44 @@
 #!/usr/bin/python
 
-from flask import Flask, request, jsonify
-import sqlite3
+from flask import Flask, request, jsonify, Response, stream_with_context
+import io
+import os
+import csv
+import json
+import itertools
+import threading
+import playlist_database
+import metrics
+from response_cache import ResponseCache, CachedResponse
+from now_playing import NowPlaying
 from datetime import datetime, timedelta
 
 app = Flask(__name__)
-DB_PATH = '/home/pi/kuvo_playlist_mastodon/playlist.db'
+# Set KUVO_DB_PATH to serve another database
+DB_PATH = os.environ.get('KUVO_DB_PATH', '/home/pi/kuvo_playlist_mastodon/playlist.db')
+
+# Each request thread keeps its read-only connection open between requests
+readers = threading.local()
+# KUVO_API_CACHE_ENTRIES=0 turns the response cache off
+response_cache = ResponseCache(int(os.environ.get('KUVO_API_CACHE_ENTRIES', 256)))
+
+# Rows to pull from SQLite at a time while streaming an export
+export_batch_size = 500
+
+# The newest spin, watched by one thread for the whole process. SSE subscribers get a comment line this often
+# when nothing's changed, so proxies don't time the connection out.
+now_playing = NowPlaying(lambda: DB_PATH)
+heartbeat_seconds = 15
+
+# Each SSE subscriber holds a request thread for as long as it's connected, so only half the pool may go to them,
+# & the other routes always have threads left. Past that, /now_playing/stream answers 503. KUVO_API_MAX_STREAMS
+# overrides it.
+max_stream_subscribers = int(os.environ.get('KUVO_API_MAX_STREAMS', max(1, int(os.environ.get('KUVO_API_THREADS', 16)) // 2)))
+stream_subscribers = threading.BoundedSemaphore(max_stream_subscribers)
+
+# Search results per page, by default & at most
+search_page_size = 50
+max_search_page_size = 500
 
 # def init_db():
 # 	conn = sqlite3.connect(DB_PATH)
@@ -25,39 +58,240 @@ DB_PATH = '/home/pi/kuvo_playlist_mastodon/playlist.db'
 # 	conn.commit()
 # 	conn.close()
 
+# This thread's read-only connection, opened the first time it's needed. A read-only connection never blocks the poller's writes.
+def get_reader():
+	if getattr(readers, 'db_path', None) != DB_PATH:
+		if getattr(readers, 'conn', None) is not None:
+			readers.conn.close()
+		readers.conn = playlist_database.connect_reader(DB_PATH)
+		readers.db_path = DB_PATH
+	return readers.conn
+
+# Answers from the response cache, building the response with build(conn) on a miss.
+# If a spin has been stored since the cache was filled, everything in it is stale, so it's cleared first.
+def cached_response(key, build):
+	conn = get_reader()
+	generation = response_cache.validate(DB_PATH, playlist_database.playlist_version(conn))
+	entry = response_cache.get(key)
+	if entry is None:
+		entry = response_cache.put(key, build(conn), generation)
+	response = Response(entry.body, mimetype=entry.mimetype)
+	response.set_etag(entry.etag)
+	# Answers 304 Not Modified if the client's If-None-Match matches
+	return response.make_conditional(request)
+
 @app.route('/songs_by_dj', methods=['GET'])
 def get_songs_by_dj():
 	dj = request.args.get('dj')
 	if not dj:
 		return jsonify({'error': 'DJ name is required'}), 400
 	
-	# Calculate the time 12 hours ago from now
-	twelve_hours_ago = datetime.now() - timedelta(hours=12)
+	# Calculate the time 12 hours ago from now, to the minute, so requests within the same minute share a cache entry
+	twelve_hours_ago = (datetime.now() - timedelta(hours=12)).replace(second=0, microsecond=0)
 
-	conn = sqlite3.connect(DB_PATH)
-	cursor = conn.cursor()
+	def build(conn):
+		songs = playlist_database.songs_by_dj(conn, dj, twelve_hours_ago)
 
-	cursor.execute('''
-		SELECT datetime_column, dj, song, artist, album
-		FROM playlist
-		WHERE dj = ? AND datetime_column >= ?
-	''', (dj, twelve_hours_ago.strftime('%Y-%m-%d %H:%M:%S')))
-	
-	songs = cursor.fetchall()
-	conn.close()
-
-	# Format the results
-	result = []
-	for song in songs:
-		result.append({
-			'datetime': song[0],
-			'dj': song[1],
-			'song': song[2],
-			'artist': song[3],
-			'album': song[4]
-		})
-
-	return jsonify(result), 200
+		# Format the results
+		result = []
+		for song in songs:
+			result.append({
+				'datetime': song[0],
+				'dj': song[1],
+				'song': song[2],
+				'artist': song[3],
+				'album': song[4]
+			})
+		return CachedResponse(jsonify(result).get_data(), 'application/json')
+
+	return cached_response(('songs_by_dj', dj, twelve_hours_ago), build)
+
+# The poller's metrics, from the last snapshot it saved to the database
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+	def build(conn):
+		samples = playlist_database.saved_metrics(conn)
+		return CachedResponse(metrics.render(samples).encode(), 'text/plain; version=0.0.4')
+
+	# Snapshots don't store spins, so they don't clear the cache. Each one gets its own entry instead.
+	return cached_response(('metrics', playlist_database.metrics_saved_at(get_reader())), build)
+
+# Reads an optional query parameter with parse(), or raises ValueError naming the parameter
+def optional_arg(name, parse):
+	value = request.args.get(name)
+	if value is None or value == '':
+		return None
+	try:
+		return parse(value)
+	except ValueError:
+		raise ValueError(f'Invalid {name}: {value}')
+
+# A parser for optional_arg: an integer no smaller than minimum. SQLite reads a negative LIMIT as no limit at all.
+def int_at_least(minimum):
+	def parse(value):
+		number = int(value)
+		if number < minimum:
+			raise ValueError(value)
+		return number
+	return parse
+
+def export_lines(rows, export_format):
+	if export_format == 'csv':
+		buffer = io.StringIO()
+		writer = csv.writer(buffer)
+		writer.writerow(playlist_database.export_columns)
+	source = iter(rows)
+	while True:
+		batch = list(itertools.islice(source, export_batch_size))
+		if not batch:
+			break
+		if export_format == 'csv':
+			writer.writerows(batch)
+			yield buffer.getvalue()
+			buffer.seek(0)
+			buffer.truncate()
+		else:
+			yield ''.join(json.dumps(dict(zip(playlist_database.export_columns, row))) + '\n' for row in batch)
+
+# Streams the playlist history as NDJSON (the default) or CSV, a batch at a time, so memory use doesn't grow
+# with the export. Optional filters: start & end (ISO dates or datetimes, end exclusive), dj & artist.
+# Rows come in id order. To page through, pass limit & then the last id you got as after_id. Archived years
+# the range reaches into are read too.
+@app.route('/export', methods=['GET'])
+def get_export():
+	export_format = request.args.get('format', 'ndjson')
+	if export_format not in ('ndjson', 'csv'):
+		return jsonify({'error': 'format must be ndjson or csv'}), 400
+	try:
+		start = optional_arg('start', datetime.fromisoformat)
+		end = optional_arg('end', datetime.fromisoformat)
+		after_id = optional_arg('after_id', int) or 0
+		limit = optional_arg('limit', int_at_least(1))
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+
+	# The export gets its own connections, held until the response is closed. The server closes them whether the
+	# stream finished or not, e.g. when the client goes away before reading anything.
+	conn = playlist_database.connect_reader(DB_PATH)
+	archives = []
+
+	def close_connections():
+		for connection in (conn, *archives):
+			connection.close()
+
+	try:
+		archives = playlist_database.open_archives(DB_PATH, playlist_database.years_between(start, end))
+		rows = playlist_database.export_rows(conn, start, end, request.args.get('dj'), request.args.get('artist'),
+											 after_id, limit, archives)
+	except Exception:
+		close_connections()
+		raise
+	if export_format == 'csv':
+		mimetype = 'text/csv'
+	else:
+		mimetype = 'application/x-ndjson'
+	response = Response(stream_with_context(export_lines(rows, export_format)), mimetype=mimetype,
+						headers={'Content-Disposition': f'attachment; filename=playlist.{export_format}'})
+	response.call_on_close(close_connections)
+	return response
+
+# Full-text search over song, artist & album. q is the search text; every word matches as a prefix.
+# Optional: field (song, artist or album) to search just that, sort=recent for newest first instead of best
+# match first, and limit & offset to page through the results. Searches archived years too.
+@app.route('/search', methods=['GET'])
+def get_search():
+	text = request.args.get('q', '')
+	if not text.strip():
+		return jsonify({'error': 'q is required'}), 400
+	field = request.args.get('field') or None
+	if field is not None and field not in playlist_database.search_fields:
+		return jsonify({'error': 'field must be song, artist or album'}), 400
+	newest = request.args.get('sort') == 'recent'
+	try:
+		limit = min(optional_arg('limit', int_at_least(1)) or search_page_size, max_search_page_size)
+		offset = optional_arg('offset', int_at_least(0)) or 0
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+
+	def build(conn):
+		result = []
+		archives = playlist_database.open_archives(DB_PATH)
+		try:
+			songs = playlist_database.search_songs(conn, text, field, newest, limit, offset, archives)
+		finally:
+			for archive in archives:
+				archive.close()
+		for song in songs:
+			result.append({
+				'id': song[0],
+				'datetime': song[1],
+				'dj': song[2],
+				'song': song[3],
+				'artist': song[4],
+				'album': song[5]
+			})
+		return CachedResponse(jsonify(result).get_data(), 'application/json')
+
+	return cached_response(('search', text, field, newest, limit, offset), build)
+
+# Top artists, albums or DJs, or spins per hour of the day, over the last day, week, month or year.
+# These read only the daily stats tables the poller keeps up to date, never the whole playlist.
+@app.route('/stats/<name>', methods=['GET'])
+def get_stats(name):
+	if name not in playlist_database.stats_tops and name != 'hourly':
+		return jsonify({'error': f'Unknown stat: {name}'}), 404
+	period = request.args.get('period', 'week')
+	if period not in playlist_database.stats_periods:
+		return jsonify({'error': 'period must be day, week, month or year'}), 400
+	try:
+		limit = min(optional_arg('limit', int_at_least(1)) or 10, max_search_page_size)
+	except ValueError as e:
+		return jsonify({'error': str(e)}), 400
+	today = datetime.now().date()
+
+	def build(conn):
+		if name == 'hourly':
+			result = [{'hour': hour, 'spins': spins} for hour, spins in playlist_database.stats_hourly(conn, period, today)]
+		else:
+			columns = playlist_database.stats_tops[name][1] + ('spins',)
+			result = [dict(zip(columns, row)) for row in playlist_database.stats_top(conn, name, period, limit, today)]
+		return CachedResponse(jsonify(result).get_data(), 'application/json')
+
+	return cached_response(('stats', name, period, limit, today), build)
+
+# The song on air right now, from memory
+@app.route('/now_playing', methods=['GET'])
+def get_now_playing():
+	spin = now_playing.latest()
+	if spin is None:
+		return jsonify({'error': 'Nothing has played yet'}), 404
+	return jsonify(spin), 200
+
+def now_playing_events(known_id):
+	while True:
+		spin = now_playing.wait_for_change(known_id, heartbeat_seconds)
+		if spin is None or spin['id'] == known_id:
+			yield ': heartbeat\n\n'
+			continue
+		known_id = spin['id']
+		yield f'id: {known_id}\nevent: spin\ndata: {json.dumps(spin)}\n\n'
+
+# Server-Sent Events: the current spin as soon as you connect, then each new one as the poller stores it.
+# A reconnecting client sends Last-Event-ID, so it only gets the current spin again if it missed it.
+# The subscriber's slot is given back when the response closes. For a client that went away, that's when a
+# heartbeat fails to send, within two of them.
+@app.route('/now_playing/stream', methods=['GET'])
+def get_now_playing_stream():
+	try:
+		known_id = int(request.headers.get('Last-Event-ID', ''))
+	except ValueError:
+		known_id = None
+	if not stream_subscribers.acquire(blocking=False):
+		return jsonify({'error': 'Too many listeners, try again later'}), 503, {'Retry-After': str(heartbeat_seconds)}
+	response = Response(now_playing_events(known_id), mimetype='text/event-stream',
+						headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+	response.call_on_close(stream_subscribers.release)
+	return response
 
 if __name__ == '__main__':
 	# init_db()
@@ -4,14 +4,143 @@ import time
 import sys
 import os
 import json
+import signal
+import argparse
+import threading
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from bs4 import BeautifulSoup
-from mastodon import Mastodon
 from datetime import datetime
 import re
-from unidecode import unidecode
-import sqlite3
-from pprint import pprint
+from spinitron_parser import parse_current_song, parse_all_songs, spin_datetime
+from album_art_cache import open_cache, caches
+from album_art_lookup import open_lookup, close_lookups
+from image_variants import open_variants, sniff_mime_type, variant_makers
+from outbox import OutboxWorker
+from poll_scheduler import PollScheduler, spin_gaps, history_size, min_history
+from page_recorder import open_recorder
+import metrics
+
+# Most cron runs find the same song still playing, fetch one page & exit, so anything only needed to store or
+# post a song is imported when it's first used: Mastodon.py & unidecode when posting, sqlite3 (via
+# playlist_database) when writing, Pillow when transcoding. benchmarks/import_time.py keeps an eye on it.
+
+
+# Seconds to wait on Spinitron before giving up on a poll. A hung request would otherwise stall the daemon forever.
+request_timeout = 30
+
+# Where the poller gets the time from. The replay driver (benchmarks/replay.py) swaps in a virtual clock, so a
+# day of recorded pages can be played through in seconds.
+clock = time
+
+# Seconds to wait on each request to a Mastodon instance, unless a destination sets its own "timeout"
+mastodon_timeout = 60
+
+# Each polling thread gets its own long-lived HTTP session, so we reuse the TCP/TLS connections to Spinitron &
+# the album art hosts between polls. With a bounded pool that's a handful of sessions no matter how many stations.
+http_local = threading.local()
+http_sessions = []
+
+# Mastodon clients keyed by (server, access token) so the daemon doesn't build a new one for every post
+mastodon_clients = {}
+mastodon_clients_lock = threading.Lock()
+
+# Every poll reads these, so a station without one is refused when the config is loaded rather than failing later
+required_station_keys = ("playlist_url", "album_art_size", "times_to_poll_per_minute", "database", "hashtags")
+
+# The stations being polled right now
+active_stations = []
+
+# Set by SIGTERM/SIGINT to stop the daemon, and by SIGHUP to reload the config
+stop_event = threading.Event()
+reload_event = threading.Event()
+# What the polling loop sleeps on: set when a poll finishes & by the signal handlers, so a stop or reload is
+# acted on straight away rather than at the next poll, which adaptive polling can put minutes off
+loop_wakeup = threading.Event()
+
+
+# Everything we keep for one Spinitron station: its config, where its state & database live,
+# the last ID we posted & what we know about its playlist page from the last poll.
+class Station:
+    def __init__(self, name, config, directory):
+        self.name = name
+        self.directory = directory
+        self.state_file = os.path.join(directory, "state")
+        # The last ID we posted. Kept in memory so we only read the state file once per process.
+        self.last_posted_id = None
+        # Validators, a hash of the part of the page we read & the parsed song from the last poll
+        self.fetch_state = {}
+        self.next_poll = 0
+        self.polls = 0
+        # How many polls to make before stopping, or None to keep polling. Cron mode sets it from the station's rate.
+        self.rounds = None
+        # For adaptive polling: when we last saw the song change (monotonic), & recent track lengths for the
+        # DJ on air, refreshed from the database at each change
+        self.last_change = None
+        self.gaps = []
+        # Posts this station's queued spins to Mastodon
+        self.outbox_worker = None
+        # Cron mode: whether the last run left posts queued. Until a run has said otherwise, assume it did.
+        self.fetch_state_file = os.path.join(directory, "fetch_state.json")
+        self.outbox_pending = True
+        self.apply_config(config)
+
+    def apply_config(self, config):
+        missing = [key for key in required_station_keys if key not in config]
+        if missing:
+            raise ValueError(f"Station '{self.name}' has no {', '.join(missing)} in the config")
+        self.config = config
+        self.database = os.path.join(self.directory, config["database"])
+        self.scheduler = PollScheduler.from_config(config) if config.get("adaptive_polling") else None
+        # Saves every page we fetch, for replaying later, if "record_pages_dir" is set
+        self.recorder = None
+        if config.get("record_pages_dir"):
+            self.recorder = open_recorder(os.path.join(working_directory, config["record_pages_dir"]), self.name)
+
+    def finished_polling(self):
+        return self.rounds is not None and self.polls >= self.rounds
+
+    def poll_interval(self):
+        if self.scheduler is None:
+            return 60 / self.config["times_to_poll_per_minute"]
+        since_change = clock.monotonic() - self.last_change if self.last_change is not None else None
+        return self.scheduler.interval(since_change, self.gaps)
+
+    # Cron mode starts each run with what the last one knew about the page: its validators, region hash & parsed
+    # song. Then an unchanged page gets a 304 or matches the hash, & the run never parses, stores or posts anything.
+    # Ignored if the playlist URL or art size has changed since.
+    def load_fetch_state(self):
+        try:
+            with open(self.fetch_state_file, 'r') as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return
+        if (saved.get("playlist_url"), saved.get("album_art_size")) == (self.config["playlist_url"], self.config["album_art_size"]):
+            self.fetch_state = {key: saved[key] for key in ("etag", "last_modified", "region_hash", "song") if key in saved}
+        self.outbox_pending = saved.get("outbox_pending", True)
+
+    # Saves the fetch state for the next run, without the page itself
+    def save_fetch_state(self):
+        saved = {key: value for key, value in self.fetch_state.items() if key != "content"}
+        saved.update(playlist_url=self.config["playlist_url"], album_art_size=self.config["album_art_size"],
+                     outbox_pending=self.outbox_pending)
+        temp_path = self.fetch_state_file + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump(saved, file)
+        os.replace(temp_path, self.fetch_state_file)
+
+    # Called when a poll finds a new song. Learns the DJ's recent track lengths, or the whole station's
+    # if the DJ is new to us.
+    def song_changed(self, song):
+        self.last_change = clock.monotonic()
+        if self.scheduler is None:
+            return
+        database = open_database(self.database)
+        gaps = spin_gaps(database.recent_spin_times(song["dj"], history_size + 1))
+        if len(gaps) < min_history:
+            gaps = spin_gaps(database.recent_spin_times(None, history_size + 1))
+        self.gaps = gaps
 
 
 # Writes the state file
@@ -34,33 +163,18 @@ def read_state(file_path):
     return state
 
 
-# Write playlist item into database
-def write_database(song, db_file):
-    # Connect to SQLite database (creates a new DB if it doesn't exist)
-    conn = sqlite3.connect(db_file)
-    # Create a cursor object to interact with the database
-    cursor = conn.cursor()
-    # Create a table to store datetime
-    cursor.execute('''CREATE TABLE IF NOT EXISTS playlist (
-                        id INTEGER PRIMARY KEY,
-                        datetime_column DATETIME,
-                        playlist_id TEXT,
-                        dj TEXT,
-                        song TEXT,
-                        artist TEXT,
-                        album TEXT,
-                        album_art TEXT
-                        )''')
-    # Get current datetime
-    current_datetime = datetime.now()
-    # Create Insert Statement
-    sql = 'INSERT INTO playlist (datetime_column, playlist_id, dj, song, artist, album, album_art) VALUES (?, ?, ?, ?, ?, ?, ?)'
-    # Insert current datetime into the table
-    cursor.execute(sql, (current_datetime, song["i"], song['dj'].replace("\u200b", ""), song['s'], song['a'], song['r'], song['image']))
-    # Commit changes and close connection
-    conn.commit()
-    conn.close()
-    return
+# Returns the shared connection to a station's database. playlist_database (& sqlite3) is only imported the
+# first time a poll has something to store.
+def open_database(db_file):
+    import playlist_database
+    return playlist_database.open_database(db_file)
+
+
+# Write playlist item into database. Each database file has one long-lived connection shared by the polling threads.
+# With post=True the song is queued in the outbox in the same transaction, once for each of destinations(song).
+# Returns False if it was already stored.
+def write_database(song, db_file, post=False, destinations=None):
+    return open_database(db_file).insert_song(song, post, destinations, current_datetime())
 
 
 # Loads the configuration file. Do all config in ./config/config.json & exclude from repo.
@@ -77,15 +191,48 @@ def get_config():
         print(f"An error occurred: {e}")
 
 
-# Function to fix the style of the time that the song played
-# example: changes "12:11 PM" to ""12:11pm"
-def format_time(time_str):
-    modified_time = time_str[:-3] + time_str[-3].replace(" ", "") + time_str[-2:].lower()
-    return modified_time
+# Builds the list of stations from the config.
+# A config with a "stations" list polls each one. Top-level keys are defaults every station inherits,
+# and each station keeps its state & database in its own directory under ./stations/<name>.
+# A config without "stations" is the original single-station setup, with its state & database in the working directory.
+def load_stations(config):
+    if "stations" not in config:
+        return [Station(config.get("name", "default"), config, working_directory)]
+    defaults = {key: value for key, value in config.items() if key != "stations"}
+    stations = []
+    for station_config in config["stations"]:
+        merged = dict(defaults)
+        merged.update(station_config)
+        if "name" not in merged:
+            raise ValueError("A station in the config has no name")
+        directory = os.path.join(working_directory, "stations", merged["name"])
+        os.makedirs(directory, exist_ok=True)
+        stations.append(Station(merged["name"], merged, directory))
+    return stations
+
+
+# Returns this thread's HTTP session, creating it the first time the thread needs one
+def get_http_session():
+    session = getattr(http_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        http_local.session = session
+        http_sessions.append(session)
+    return session
+
+
+def current_datetime():
+    return datetime.fromtimestamp(clock.time())
+
+
+# The current date and time in a human-readable form, for the log lines
+def timestamp():
+    return current_datetime().strftime("%A, %B %d, %Y %I:%M:%S %p")
 
 
 # Cleanse the string
 def clean_string(string):
+    from unidecode import unidecode
     # Using unidecode to convertion UTF-8 diacriticals to standard ASCII because people probably won't type them in hashtags
     text = unidecode(string)
     # Remove any special characters, new lines, and spaces
@@ -102,127 +249,508 @@ def make_hashtags(artist, song, dj, always_tag):
     return hashtag_string
 
 
+# Pulls out the only parts of the playlist page we read: the show title & the first spin-item row.
+# Everything else on the page (timestamps, ads, widgets) can change without the song changing.
+# Returns None if the markup isn't where we expect, in which case we always parse.
+def page_region(content):
+    title_at = content.find(b'show-title')
+    spin_at = content.find(b'spin-item')
+    if title_at == -1 or spin_at == -1:
+        return None
+    title_start = content.rfind(b'<', 0, title_at)
+    title_end = content.find(b'</h3>', title_at)
+    spin_start = content.rfind(b'<tr', 0, spin_at)
+    spin_end = content.find(b'</tr>', spin_at)
+    if -1 in (title_start, title_end, spin_start, spin_end):
+        return None
+    return content[title_start:title_end] + content[spin_start:spin_end]
+
+
+# Fetches the playlist page with a conditional GET on our long-lived session.
+# Returns (response, region_hash), or (None, None) if the page is unchanged since the last poll, either
+# because the server said 304 or because the part of the page we read hashes the same. A recorder, if given,
+# gets every response.
+def fetch_playlist_page(playlist_url, album_art_size, fetch_state, recorder=None):
+    headers = {}
+    # Only send validators once we have a parsed song to fall back on
+    if "song" in fetch_state:
+        if fetch_state.get("etag"):
+            headers["If-None-Match"] = fetch_state["etag"]
+        if fetch_state.get("last_modified"):
+            headers["If-Modified-Since"] = fetch_state["last_modified"]
+    with metrics.timer("fetch"):
+        response = get_http_session().get(playlist_url, headers=headers, timeout=request_timeout)
+    if recorder:
+        recorder.record(playlist_url, response, clock.time())
+    if response.status_code == 304 and "song" in fetch_state:
+        return None, None
+    region = page_region(response.content)
+    region_hash = None
+    if region is not None:
+        region_hash = hashlib.sha1(album_art_size.encode() + region).hexdigest()
+        if region_hash == fetch_state.get("region_hash") and "song" in fetch_state:
+            # Keep the newest validators so the next poll can get a 304
+            fetch_state["etag"] = response.headers.get("ETag")
+            fetch_state["last_modified"] = response.headers.get("Last-Modified")
+            return None, None
+    return response, region_hash
+
+
 # Scrapes the KUVO playlist page & gets the current artist, song, album, art & song ID
 # Sometimes the "Now Playing" song is more current on the KUVO playlist site. But it doesn't
 # contain the name of the album & it rarely contains album art. So I'm choosing to read from
 # the playlist table in order to get richer information.
-def get_current_song(playlist_url, album_art_size):
+def get_current_song(playlist_url, album_art_size, fetch_state, recorder=None, station_name="default"):
     # Get the playlist HTML from KUVO
-    response = requests.get(playlist_url)
+    response, region_hash = fetch_playlist_page(playlist_url, album_art_size, fetch_state, recorder)
+    # Nothing changed, so skip parsing & hand back what we parsed last time
+    if response is None:
+        metrics.increment("kuvo_polls_unchanged_total", station=station_name)
+        return dict(fetch_state["song"])
     # Check if the request was successful (status code 200)
     if response.status_code == 200:
-        # Parse the content using BeautifulSoup
-        soup = BeautifulSoup(response.content, 'html.parser')
-        # Find the <tr> tag with class "spin-item"
-        spin_item = soup.find('tr', class_='spin-item')
-        # Check if the tag with class "spin-item" is found
-        if spin_item:
-            # Uncomment to debug. This will print the scraped HTML section of the playlist so you can see what's going on
-            # pprint(spin_item)
-            # Get the value of the "data-spin" attribute
-            data_spin_value = spin_item.get('data-spin')
-            # Convert it to a dict
-            data_spin_item = json.loads(data_spin_value)
-            # Pull the time the song was played out of the <td>
-            data_spin_item["time"] = format_time( spin_item.find('td', class_='spin-time').get_text(strip=True) )
-            if data_spin_item["i"] is None:
-                data_spin_item["i"] = data_spin_item["s"]
-                print(f"***** No ID on the song, so I set the i value to {data_spin_item['i']}")
-        else:
-            data_spin_item = json.loads({"i":"notfound","a":"artist_not_found","s":"song_not_found","r":"album_not_found"})
-        # Find the DJ
-        data_spin_item["dj"] = soup.find('h3', 'show-title').get_text(strip=True).title()
-        # Get the image source
-        img_tag = spin_item.find('td', class_='spin-art').find('img')
-        if img_tag:
-            # Get the value of the "src" attribute
-            src_attribute = img_tag.get('src')
-            # Check if the "src" attribute exists
-            if src_attribute:
-                # push album art link into data_spin_item and resize to size specified in config
-                # data_spin_item["image"] = src_attribute.replace("170x170", album_art_size)
-                data_spin_item["image"] = re.sub(
-                    r'^(.*)/\d+x\d+(.*\.jpg)$',
-                    r'\1/' + album_art_size + r'\2',
-                    src_attribute
-                )
-                
-            # Check if there's generic art because there's no album image:
-            if data_spin_item["image"] == "https://spinitron.com/static/pictures/placeholders/loudspeaker.svg":
-                data_spin_item["image_status"] = "no image"
-            else:
-                data_spin_item["image_status"] = "image"
+        # Pull the first spin-item out of the page. This only builds a full BeautifulSoup tree if the fast parser can't.
+        with metrics.timer("parse"):
+            data_spin_item = parse_current_song(response.content, album_art_size)
+
+        # Remember this parse so unchanged polls can skip it
+        fetch_state["song"] = dict(data_spin_item)
+        # Keep the page too, in case we need to catch up on the older spins on it
+        fetch_state["content"] = response.content
+        fetch_state["region_hash"] = region_hash
+        fetch_state["etag"] = response.headers.get("ETag")
+        fetch_state["last_modified"] = response.headers.get("Last-Modified")
 
     return data_spin_item 
 
 
-# Your standard posting to Mastodon function
-def post_to_mastodon(current_song, server, access_token):
-    # Create an app on your Mastodon instance and get the access token
-    mastodon = Mastodon(
-        access_token=access_token,
-        api_base_url=server
-    )
+# Returns a Mastodon client for this server & token, creating it the first time it's needed. Clients live as
+# long as the process, so each keeps its connection to the instance open between posts.
+def get_mastodon_client(server, access_token, timeout=None):
+    key = (server, access_token)
+    with mastodon_clients_lock:
+        if key not in mastodon_clients:
+            from mastodon import Mastodon
+            # Create an app on your Mastodon instance and get the access token
+            # Rate limits are handled by the outbox worker, so have the client raise instead of sleeping
+            mastodon_clients[key] = Mastodon(
+                access_token=access_token,
+                api_base_url=server,
+                ratelimit_method="throw",
+                request_timeout=timeout or mastodon_timeout
+            )
+        return mastodon_clients[key]
+
+
+# The Mastodon accounts a station posts to, by name. Without "destinations" it's just the station's own
+# mastodon_server & mastodon_access_token, named ''.
+def station_destinations(config):
+    if "destinations" not in config:
+        return {"": config}
+    return {destination["name"]: destination for destination in config["destinations"]}
+
+
+# Which destinations a new spin is queued for. One with "djs" only gets those DJs' shows, e.g. a show's own account.
+def song_destinations(station, song):
+    dj = song["dj"].replace("\u200b", "").strip().lower()
+    return [name for name, destination in station_destinations(station.config).items()
+            if not destination.get("djs") or dj in {show_dj.strip().lower() for show_dj in destination["djs"]}]
+
+
+# The client for one of a station's destinations. Posts queued before "destinations" was set are for '',
+# the station's own account.
+def destination_client(station, name):
+    destinations = station_destinations(station.config)
+    if name in destinations:
+        destination = destinations[name]
+    elif name == "" and "mastodon_server" in station.config:
+        destination = station.config
+    else:
+        # Left to fail & retry like any other error, in case the destination comes back with a config reload
+        raise ValueError(f"No destination named '{name}' in the config")
+    return get_mastodon_client(destination["mastodon_server"], destination["mastodon_access_token"],
+                               destination.get("timeout"))
+
+
+# Returns the album art cache. Every station shares it unless the config says otherwise, since stations
+# playing the same genre replay a lot of the same albums.
+def get_album_art_cache(config):
+    directory = os.path.join(working_directory, config.get("album_art_cache_dir", "album_art_cache"))
+    return open_cache(directory, config.get("album_art_cache_bytes", 50 * 1024 * 1024))
+
+
+# What shrinks covers before upload, or None if "image_format" is "original" (or not set)
+def get_image_variants(config):
+    image_format = config.get("image_format", "original")
+    if image_format == "original":
+        return None
+    directory = os.path.join(working_directory, config.get("image_variant_cache_dir", "album_art_variants"))
+    store = open_cache(directory, config.get("image_variant_cache_bytes", 20 * 1024 * 1024))
+    return open_variants(store, image_format=image_format, size=config.get("image_size", 640),
+                         quality=config.get("image_quality", 82), max_bytes=config.get("image_max_bytes", 0))
+
+
+# The album art lookup for spins Spinitron has no art for, or None if "mbid_api_url" & "art_api_url" aren't set
+def get_album_art_lookup(station):
+    config = station.config
+    if not (config.get("mbid_api_url") and config.get("art_api_url")):
+        return None
+    return open_lookup(open_database(station.database), get_album_art_cache(config), get_http_session,
+                       config["mbid_api_url"], config["art_api_url"], size=config.get("art_lookup_size", 800),
+                       workers=config.get("art_lookup_workers", 2),
+                       negative_ttl=config.get("art_lookup_retry_hours", 168) * 3600)
+
+
+# Your standard posting to Mastodon function. With an art_lookup, spins without art on Spinitron get a cover
+# from MusicBrainz when there is one. With variants, covers are shrunk before they're uploaded.
+def post_to_mastodon(current_song, server, access_token, hashtags, art_cache, art_lookup=None, variants=None):
+    prepared = prepare_post(current_song, hashtags, art_cache, art_lookup, variants)
+    send_post(prepared, get_mastodon_client(server, access_token))
+
+
+# Everything about a post that's the same for every account it goes to: the text, the cover & its alt text.
+# Done once per spin, however many destinations it has.
+def prepare_post(current_song, hashtags, art_cache, art_lookup=None, variants=None):
     # Text content to post
     text_to_post = current_song["time"] + " " + current_song["s"] + " by " + current_song["a"] + " from " + current_song["r"]
-    text_to_post += "\n" + make_hashtags(current_song["a"], current_song["s"], current_song["dj"], config["hashtags"])
+    text_to_post += "\n" + make_hashtags(current_song["a"], current_song["s"], current_song["dj"], hashtags)
     print(text_to_post)
     alt_text = "An image of the cover of the record album '" + current_song["r"] + "' by " + current_song["a"]
 
-    # Check if there's an image included. If there is, post it
+    # Check if there's an image included. If there is, get it ready to upload
+    image_path = None
     if current_song["image_status"] == "image":
-    # URL of the image you want to attach
-        image_data = requests.get(current_song["image"]).content
-        # Upload the image and attach it to the status
-        media = mastodon.media_post(image_data, mime_type='image/jpeg', description=alt_text)
+        # Get the image from the album art cache, downloading it only if we haven't seen this album before
+        with metrics.timer("album_art"):
+            image_path = art_cache.get(current_song["image"], get_http_session(), request_timeout)
+    elif art_lookup:
+        # Usually already fetched in the background when the spin was first seen
+        with metrics.timer("album_art"):
+            image_path = art_lookup.image_for(current_song)
+    mime_type = None
+    if image_path:
+        # This runs on the outbox worker, so transcoding never holds up polling
+        if variants:
+            image_path, mime_type = variants.variant_for(image_path)
+        else:
+            mime_type = sniff_mime_type(image_path)
+    return {"song": current_song, "text": text_to_post, "alt_text": alt_text, "image_path": image_path,
+            "mime_type": mime_type}
+
+
+# Posts a prepared song to one account: uploads the cover, if there is one, & posts the status
+def send_post(prepared, mastodon):
+    current_song = prepared["song"]
+    if prepared["image_path"]:
+        # Upload the image and attach it to the status. Hand Mastodon.py an open file: given a path, it ignores
+        # mime_type & guesses from the extension, and cache files don't have one.
+        with open(prepared["image_path"], 'rb') as image_file, metrics.timer("media_upload"):
+            media = mastodon.media_post(image_file, mime_type=prepared["mime_type"], description=prepared["alt_text"])
         # Post the status with text and image attachment
-        mastodon.status_post(status=text_to_post, media_ids=[media['id']], visibility="public")
+        with metrics.timer("status_post"):
+            mastodon.status_post(status=prepared["text"], media_ids=[media['id']], visibility="public")
     else:
-        mastodon.status_post(status=text_to_post, visibility="public")
-    print(f"***** Posted ID: {current_song['s']} by {current_song['a']} to Mastodon at {formatted_datetime}")
-    return 
+        with metrics.timer("status_post"):
+            mastodon.status_post(status=prepared["text"], visibility="public")
+    print(f"***** Posted ID: {current_song['s']} by {current_song['a']} to {mastodon.api_base_url} at {timestamp()}")
+
 
+# Finds the spins on the page older than the current one that never made it into the database, e.g. because
+# the poller was down or two songs changed between polls. Archives them in one transaction, oldest first,
+# and with "backfill": "post" queues them to post in order too. "backfill": "off" skips all of this.
+def catch_up_missed_songs(station, current_song, last_post):
+    config = station.config
+    backfill = config.get("backfill", "archive")
+    if backfill == "off" or "content" not in station.fetch_state:
+        return
+    songs = parse_all_songs(station.fetch_state["content"], config["album_art_size"])
+    database = open_database(station.database)
+    stored = database.stored_ids(song["i"] for song in songs)
+    # Everything below the current song that we don't have yet, oldest first
+    missed = [song for song in songs[1:] if song["i"] not in stored and song["i"] != "notfound"]
+    missed.reverse()
+    if not missed:
+        return
+    # Don't flood Mastodon with the whole page the very first time a station runs
+    post = backfill == "post" and last_post != "starting up"
+    now = current_datetime()
+    inserted = database.insert_songs([(song, spin_datetime(song["time"], now)) for song in missed], post,
+                                     functools.partial(song_destinations, station))
+    art_lookup = get_album_art_lookup(station)
+    if post and art_lookup:
+        for song in inserted:
+            art_lookup.prefetch(song)
+    print(f"***** [{station.name}] Archived {len(missed)} missed song(s){' & queued them to post' if post else ''}.  {timestamp()}")
 
-def orchestration_function():
+
+def orchestration_function(station):
+    config = station.config
+    metrics.increment("kuvo_polls_total", station=station.name)
     # Get the information about the current song playing
-    current_song = get_current_song(config["playlist_url"], config["album_art_size"])
-    # pprint(current_song)
-    state_file = working_directory + "/state"
-    # Get the latest ID written to the state file
-    last_post = read_state(state_file)
+    with metrics.timer("scrape"):
+        current_song = get_current_song(config["playlist_url"], config["album_art_size"], station.fetch_state,
+                                        station.recorder, station.name)
+    # Get the latest ID written to the state file. Only the first poll of a process needs to read it.
+    if station.last_posted_id is None:
+        station.last_posted_id = read_state(station.state_file)
+    last_post = station.last_posted_id
 
     # Check if we've already posted this song by comparing the ID we recieved from the scrape
     # with the one in the state file
     if current_song["i"] != last_post:
         # Make sure we got a good scrape of playlist page
         if current_song["i"] == "notfound":
-            print(f"***** Latest song not found.  {formatted_datetime}")
+            print(f"***** [{station.name}] Latest song not found.  {timestamp()}")
         else:
-            post_to_mastodon(current_song, config["mastodon_server"], config["mastodon_access_token"])
-            write_state(state_file, current_song["i"])
-            write_database(current_song, working_directory + "/" + config["database"])
+            metrics.increment("kuvo_changes_total", station=station.name)
+            with metrics.timer("catch_up"):
+                catch_up_missed_songs(station, current_song, last_post)
+            # Archive the song & queue it for the outbox worker to post. Scraping never waits on Mastodon.
+            with metrics.timer("database"):
+                write_database(current_song, station.database, post=True,
+                               destinations=functools.partial(song_destinations, station))
+            # Start looking for a cover now if Spinitron doesn't have one, so the post doesn't wait on it
+            art_lookup = get_album_art_lookup(station)
+            if art_lookup:
+                art_lookup.prefetch(current_song)
+            write_state(station.state_file, current_song["i"])
+            station.last_posted_id = current_song["i"]
+            station.song_changed(current_song)
+            # A cron run only starts the worker once it has something to post
+            if station.outbox_worker is None:
+                start_outbox_worker(station)
+            station.outbox_worker.wake()
     else:
-        print(f"***** Song: {current_song['s']} by {current_song['a']} already posted.  {formatted_datetime}")
+        print(f"***** [{station.name}] Song: {current_song['s']} by {current_song['a']} already posted.  {timestamp()}")
     return
 
 
-# Setup Global Variables:
-if len(sys.argv) > 1:
-    working_directory = sys.argv[1]
-    print (f"{working_directory} provided")
-    config = get_config()
-else:
-    print("No working directory argument provided. Exiting.\n")
-    sys.exit()
+# Prepares one queued song for posting, using the station's current config
+def prepare_station_post(station, song):
+    config = station.config
+    return prepare_post(song, config["hashtags"], get_album_art_cache(config), get_album_art_lookup(station),
+                        get_image_variants(config))
+
+
+def send_station_post(station, prepared, destination):
+    send_post(prepared, destination_client(station, destination))
+
+
+def start_outbox_worker(station):
+    station.outbox_worker = OutboxWorker(station.name, open_database(station.database),
+                                         functools.partial(prepare_station_post, station),
+                                         functools.partial(send_station_post, station),
+                                         functools.partial(destination_client, station),
+                                         station.config.get("outbox_max_attempts", 10))
+    station.outbox_worker.start()
+
+
+# The outbox worker keeps going through errors, but if its thread dies anyway the station's posts would queue up
+# unseen, so start a new one
+def restart_dead_outbox_workers(stations):
+    for station in stations:
+        worker = station.outbox_worker
+        if worker is None or worker.is_alive() or worker.finishing or worker.stop_event.is_set():
+            continue
+        metrics.increment("kuvo_outbox_restarts_total", station=station.name)
+        print(f"***** [{station.name}] Outbox worker died, restarting it.  {timestamp()}")
+        start_outbox_worker(station)
+
+
+# Polls one station. One bad poll (network blip, odd page) shouldn't take the other stations or the daemon down.
+def poll_station(station):
+    try:
+        orchestration_function(station)
+    except Exception as e:
+        metrics.increment("kuvo_poll_failures_total", station=station.name)
+        print(f"***** [{station.name}] Poll failed: {e}  {timestamp()}")
+    station.polls += 1
+
+
+# Polls every station on its own schedule from a bounded thread pool. A station is never polled twice at
+# once, and a slow station only ties up its own thread, so the others keep to their schedules.
+# A station with rounds set stops after that many polls, & once every station has stopped we return.
+# Otherwise we run until told to stop.
+def run_stations(stations):
+    max_workers = config.get("max_workers", max(1, min(len(stations), 8)))
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="poller")
+    global active_stations
+    active_stations = stations
+    in_flight = {}
+    while not stop_event.is_set():
+        # Cleared before looking, so anything that happens from here on wakes the sleep below
+        loop_wakeup.clear()
+        if reload_event.is_set():
+            reload_event.clear()
+            stations = active_stations = reload_config(stations)
+        restart_dead_outbox_workers(stations)
+        now = time.monotonic()
+        for station in stations:
+            if station.name in in_flight or now < station.next_poll:
+                continue
+            if station.finished_polling():
+                continue
+            station.next_poll = now + station.poll_interval()
+            in_flight[station.name] = executor.submit(poll_station, station)
+            in_flight[station.name].add_done_callback(lambda future: loop_wakeup.set())
+        for name, future in list(in_flight.items()):
+            if future.done():
+                del in_flight[name]
+        if not in_flight and stations and all(station.finished_polling() for station in stations):
+            break
+        # Sleep until the next station is due, one of the running polls finishes, or a signal arrives
+        pending = [station.next_poll for station in stations
+                   if station.name not in in_flight and not station.finished_polling()]
+        timeout = max(0, min(pending) - time.monotonic()) if pending else None
+        loop_wakeup.wait(timeout)
+    executor.shutdown(wait=True)
+    return stations
 
-for i in range(0, config["times_to_poll_per_minute"] - 1):
-    # Get the current date and time
-    current_datetime = datetime.now()
-    # Format the date and time into a human-readable form
-    formatted_datetime = current_datetime.strftime("%A, %B %d, %Y %I:%M:%S %p")
-    orchestration_function()
-    # Don't sleep after the last run 
-    if i < (config["times_to_poll_per_minute"] - 1):
-        time.sleep(60 / config["times_to_poll_per_minute"])
 
+# Saves a snapshot of the metrics to the database the playlist API reads them from: "metrics_database" if it's
+# set, otherwise the first station's database
+def save_metrics(stations):
+    if not stations:
+        return
+    db_file = stations[0].database
+    if config.get("metrics_database"):
+        db_file = os.path.join(working_directory, config["metrics_database"])
+    try:
+        open_database(db_file).save_metrics(metrics.samples())
+    except Exception as e:
+        print(f"***** Couldn't save metrics: {e}  {timestamp()}")
+
+
+# Saves the metrics every "metrics_save_seconds" until the daemon stops
+def save_metrics_periodically():
+    while not stop_event.wait(config.get("metrics_save_seconds", 60)):
+        save_metrics(active_stations)
+
+
+# The original cron mode: poll a few times across one minute & exit.
+# Whatever is still queued at the end gets a few seconds to post, & the rest waits for the next run.
+# A run is too short to learn anything from, so cron mode always polls on the fixed schedule.
+# Most runs find the same song still playing. Those only fetch the page: the database is opened, & the outbox
+# worker started, only if a poll finds a new song or the last run left posts queued.
+def run_once():
+    stations = load_stations(config)
+    for station in stations:
+        station.scheduler = None
+        # Each station's own rate, since a station can set times_to_poll_per_minute to override the default
+        station.rounds = station.config["times_to_poll_per_minute"] - 1
+        station.load_fetch_state()
+        if station.outbox_pending:
+            start_outbox_worker(station)
+    if stations:
+        run_stations(stations)
+    for station in stations:
+        if station.outbox_worker:
+            station.outbox_worker.finish(config.get("outbox_finish_seconds", 15))
+            station.outbox_pending = station.outbox_worker.database.next_post_time() is not None
+        station.save_fetch_state()
+    close_lookups()
+    # Metrics aren't saved: a run's counters cover one minute, & most runs never open a database to save them
+    # in, so a snapshot would only ever show the last run that found a song. Persisted metrics are daemon-only.
+
+
+# Re-reads config.json. If the new file is broken we keep running on the old one.
+# Stations that are still configured keep their state; new ones are added & removed ones dropped.
+# Everything that can fail (reading the file, building the stations, opening new stations' databases) happens
+# before anything running is touched, so a bad config leaves the old config & stations exactly as they were.
+def reload_config(stations):
+    global config
+    new_config = get_config()
+    if not new_config:
+        print(f"***** Config reload failed, keeping the old config.  {timestamp()}")
+        return stations
+    existing = {station.name: station for station in stations}
+    added = []
+    try:
+        new_stations = load_stations(new_config)
+        for station in new_stations:
+            if station.name not in existing:
+                start_outbox_worker(station)
+                added.append(station)
+    except Exception as e:
+        for station in added:
+            station.outbox_worker.stop()
+        print(f"***** Config reload failed ({e}), keeping the old config.  {timestamp()}")
+        return stations
+    config = new_config
+    reloaded = []
+    for station in new_stations:
+        if station.name in existing:
+            existing[station.name].apply_config(station.config)
+            reloaded.append(existing[station.name])
+        else:
+            reloaded.append(station)
+    for station in existing.values():
+        if station not in reloaded and station.outbox_worker:
+            station.outbox_worker.stop()
+    print(f"***** Reloaded config, polling {len(reloaded)} station(s).  {timestamp()}")
+    return reloaded
 
+
+def handle_stop_signal(signum, frame):
+    stop_event.set()
+    loop_wakeup.set()
+
+
+def handle_reload_signal(signum, frame):
+    reload_event.set()
+    loop_wakeup.set()
+
+
+# Daemon mode: stay resident & keep polling every station until we get SIGTERM
+def run_daemon():
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    signal.signal(signal.SIGHUP, handle_reload_signal)
+    stations = load_stations(config)
+    print(f"***** Starting daemon, pid {os.getpid()}, polling {len(stations)} station(s)")
+    for station in stations:
+        start_outbox_worker(station)
+    # Serve /metrics straight from the daemon if asked to, & keep a snapshot in the database for the API
+    metrics_server = None
+    if config.get("metrics_port"):
+        metrics_server = metrics.start_server(config["metrics_port"], config.get("metrics_host", "127.0.0.1"))
+    threading.Thread(target=save_metrics_periodically, name="metrics-saver", daemon=True).start()
+    stations = run_stations(stations)
+    save_metrics(stations)
+    if metrics_server:
+        metrics_server.shutdown()
+    for station in stations:
+        station.outbox_worker.stop()
+    for station in stations:
+        station.outbox_worker.join(request_timeout)
+    close_lookups()
+    for session in http_sessions:
+        session.close()
+    import playlist_database
+    playlist_database.close_databases()
+    for directory, cache in caches.items():
+        print(f"***** Album art cache {directory}: {cache.stats()}")
+    for (directory, settings), variants in variant_makers.items():
+        print(f"***** Image variants {dict(settings)['image_format']} in {directory}: {variants.stats()}")
+    print("***** Daemon stopped")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Post the current song on Spinitron playlists to Mastodon.")
+    parser.add_argument("working_directory", nargs="?", help="Directory holding config/config.json, the state files & the databases")
+    parser.add_argument("--daemon", action="store_true", help="Keep running & polling instead of exiting after a minute")
+    args = parser.parse_args()
+
+    # Setup Global Variables:
+    if args.working_directory:
+        working_directory = args.working_directory
+        print (f"{working_directory} provided")
+        config = get_config()
+    else:
+        print("No working directory argument provided. Exiting.\n")
+        sys.exit()
+
+    if args.daemon:
+        run_daemon()
+    else:
+        run_once()
@@ -3,7 +3,8 @@
 import sqlite3
 
 
-sql = "select * from playlist order by datetime_column desc limit 1"
+# The newest row has the highest id, which is much cheaper to find than the latest datetime_column
+sql = "select * from playlist order by id desc limit 1"
 
 # Connect to the SQLite database
 conn = sqlite3.connect('playlist.db')
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+
+# Counters & latency histograms for the poller, in Prometheus text format.
+#
+# Everything is in-process & cheap: recording a value is a dict lookup & an add under a lock. The daemon can
+# serve the metrics itself on "metrics_port", and saves a snapshot to the metrics table in the database every
+# "metrics_save_seconds" so the playlist API can serve them at /metrics too.
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# Histogram buckets in seconds. Polls & posts take anywhere from milliseconds to a minute or more.
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+lock = threading.Lock()
+# name -> (type, help)
+descriptions = {}
+# (name, labels) -> value for counters
+counter_values = {}
+# (name, labels) -> [bucket counts..., sum, count] for histograms
+histogram_values = {}
+
+
+def describe(name, metric_type, help_text):
+    descriptions[name] = (metric_type, help_text)
+
+
+describe("kuvo_polls_total", "counter", "Polls of a station's playlist page")
+describe("kuvo_polls_unchanged_total", "counter", "Polls where the playlist page hadn't changed")
+describe("kuvo_poll_failures_total", "counter", "Polls that raised an error")
+describe("kuvo_changes_total", "counter", "Polls that found a new song")
+describe("kuvo_posts_total", "counter", "Songs posted to Mastodon")
+describe("kuvo_post_failures_total", "counter", "Failed attempts to post a song to Mastodon")
+describe("kuvo_outbox_errors_total", "counter", "Errors reading or updating the outbox, e.g. a locked database")
+describe("kuvo_outbox_restarts_total", "counter", "Outbox workers restarted after their thread died")
+describe("kuvo_stage_seconds", "histogram", "Time spent in each stage of polling & posting")
+describe("kuvo_art_lookups_total", "counter", "Album art lookups for spins without art, by result")
+describe("kuvo_image_bytes_saved_total", "counter", "Bytes of album art upload saved by transcoding")
+describe("kuvo_scrape_to_post_seconds", "histogram", "Time from a song being queued to it being posted")
+
+
+# Labels are stored as a sorted tuple of pairs so they can be dict keys
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def increment(name, amount=1, **labels):
+    key = (name, label_key(labels))
+    with lock:
+        counter_values[key] = counter_values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    key = (name, label_key(labels))
+    position = bisect.bisect_left(default_buckets, value)
+    with lock:
+        values = histogram_values.get(key)
+        if values is None:
+            values = histogram_values[key] = [0] * (len(default_buckets) + 2)
+        if position < len(default_buckets):
+            values[position] += 1
+        values[-2] += value
+        values[-1] += 1
+
+
+# Times the body into kuvo_stage_seconds{stage=...}
+@contextmanager
+def timer(stage, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("kuvo_stage_seconds", time.perf_counter() - started, stage=stage, **labels)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+# Every sample as (name, labels, metric type, value). Histograms become cumulative _bucket, _sum & _count samples.
+def samples():
+    result = []
+    with lock:
+        counters = list(counter_values.items())
+        histograms = [(key, list(values)) for key, values in histogram_values.items()]
+    for (name, labels), value in counters:
+        result.append((name, format_labels(labels), "counter", value))
+    for (name, labels), values in histograms:
+        cumulative = 0
+        for bound, count in zip(default_buckets, values):
+            cumulative += count
+            result.append((f"{name}_bucket", format_labels(labels + (("le", repr(float(bound))),)), "histogram", cumulative))
+        result.append((f"{name}_bucket", format_labels(labels + (("le", "+Inf"),)), "histogram", values[-1]))
+        result.append((f"{name}_sum", format_labels(labels), "histogram", values[-2]))
+        result.append((f"{name}_count", format_labels(labels), "histogram", values[-1]))
+    return result
+
+
+# Renders (name, labels, type, value) samples as Prometheus text, with HELP & TYPE lines for each family
+def render(sample_list):
+    lines = []
+    seen = set()
+    for name, labels, metric_type, value in sorted(sample_list, key=lambda sample: sample[0]):
+        family = name
+        for suffix in ("_bucket", "_sum", "_count"):
+            if metric_type == "histogram" and name.endswith(suffix):
+                family = name[:-len(suffix)]
+        if family not in seen:
+            seen.add(family)
+            help_text = descriptions.get(family, (metric_type, family))[1]
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+        lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render(samples()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# Serves /metrics from a background thread. Returns the server so it can be shut down.
+def start_server(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
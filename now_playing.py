@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+# The latest spin, kept in memory for the playlist API's /now_playing endpoints.
+#
+# One watcher thread per process checks PRAGMA data_version on its own read-only connection a couple of times a
+# second. Only when the poller has committed something does it read the newest spin. Subscribers to the
+# Server-Sent Events stream wait on a Condition, so hundreds of them cost no database work at all: they're
+# woken together when the spin changes, or when it's time to send a heartbeat.
+
+import time
+import threading
+import playlist_database
+
+
+# How often the watcher checks the database for a commit, in seconds
+watch_interval = 0.5
+
+
+class NowPlaying:
+    # get_db_path() is called on every check, so the API can point at another database while running
+    def __init__(self, get_db_path, interval=None):
+        self.get_db_path = get_db_path
+        self.interval = interval or watch_interval
+        self.condition = threading.Condition()
+        # The newest spin as a dict, or None before anything is stored
+        self.spin = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+
+    # Starts the watcher the first time anyone asks, & waits for its first read so callers never see a blank
+    def start(self):
+        with self.start_lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.watch, name="now-playing", daemon=True)
+            self.ready = threading.Event()
+            self.thread.start()
+        self.ready.wait(5)
+
+    def watch(self):
+        conn = None
+        db_path = None
+        version = None
+        while True:
+            try:
+                if db_path != self.get_db_path():
+                    if conn is not None:
+                        conn.close()
+                    db_path = self.get_db_path()
+                    conn = playlist_database.connect_reader(db_path)
+                    version = None
+                current = playlist_database.data_version(conn)
+                if current != version:
+                    version = current
+                    self.update(playlist_database.latest_spin(conn))
+            except Exception as e:
+                print(f"***** Now playing: couldn't read {db_path}: {e}")
+                if conn is not None:
+                    conn.close()
+                conn = db_path = None
+            self.ready.set()
+            time.sleep(self.interval)
+
+    def update(self, spin):
+        with self.condition:
+            # Any commit wakes us, e.g. an outbox update, so only tell subscribers when the spin itself changed
+            if spin == self.spin:
+                return
+            self.spin = spin
+            self.condition.notify_all()
+
+    def latest(self):
+        self.start()
+        return self.spin
+
+    # Waits up to timeout seconds for a spin other than `known` (compared by id). Returns the current spin
+    # either way, so a caller that gets `known` back knows it timed out.
+    def wait_for_change(self, known_id, timeout):
+        self.start()
+        with self.condition:
+            self.condition.wait_for(lambda: self.spin is not None and self.spin["id"] != known_id, timeout)
+            return self.spin
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# Drains a station's outbox table to Mastodon.
+#
+# The poller only queues new spins (see PlaylistDatabase.insert_songs), so a slow or rate-limited Mastodon
+# instance never holds up scraping. Each station has one worker thread that posts queued spins oldest first.
+# A spin is queued once per destination (account) it goes to. The worker prepares it once, fetching the art
+# & building the text, then posts to all its destinations at the same time, so a spin takes as long as the
+# slowest instance rather than the sum of them. Each destination succeeds, fails & is retried on its own.
+# Failed posts are retried with exponential backoff. When an instance's X-RateLimit headers say we're out of
+# requests, its posts wait until the window resets, so a backlog drains at the rate each instance allows.
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+
+# Seconds to wait before the first retry of a failed post. Each further failure doubles it, up to the cap.
+base_retry_delay = 30
+max_retry_delay = 3600
+
+# How long to sleep when the outbox is empty. The poller wakes the worker early when it queues something.
+idle_wait = 60
+
+# Most destinations a spin is posted to at once
+max_concurrent_posts = 8
+
+# How long to back off when the outbox itself can't be read or updated, e.g. while a vacuum or compact holds the
+# database for longer than its busy timeout
+error_retry_delay = 10
+
+
+def retry_delay(attempts):
+    return min(base_retry_delay * 2 ** (attempts - 1), max_retry_delay)
+
+
+class OutboxWorker(threading.Thread):
+    # prepare_post(song) does the work every destination shares & returns what send_post(prepared, destination)
+    # needs to post it to one of them. get_client(destination) returns the Mastodon client for a destination, so
+    # we can read its rate limit state. After max_attempts failures a post is marked failed & left in the table.
+    def __init__(self, name, database, prepare_post, send_post, get_client, max_attempts=10):
+        super().__init__(name=f"outbox-{name}", daemon=True)
+        self.station_name = name
+        self.database = database
+        self.prepare_post = prepare_post
+        self.send_post = send_post
+        self.get_client = get_client
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_posts, thread_name_prefix=f"post-{name}")
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.finishing = False
+
+    # Tells the worker there's something new in the outbox
+    def wake(self):
+        self.wake_event.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.drain()
+                if self.finishing:
+                    break
+                timeout = self.seconds_until_next_post()
+            except Exception as e:
+                # The posts are still queued, so keep the thread alive & try again. Only stopping cuts the wait
+                # short, so a poll queueing more doesn't hammer a locked database.
+                metrics.increment("kuvo_outbox_errors_total", station=self.station_name)
+                print(f"***** [{self.station_name}] Outbox error, retrying in {error_retry_delay}s: {e}")
+                self.stop_event.wait(error_retry_delay)
+                continue
+            self.wake_event.wait(timeout)
+            self.wake_event.clear()
+        self.executor.shutdown(wait=False)
+
+    def seconds_until_next_post(self):
+        next_post_time = self.database.next_post_time()
+        if next_post_time is None:
+            return idle_wait
+        return min(max(0, next_post_time - time.time()), idle_wait)
+
+    # Posts everything that's due, oldest spin first
+    def drain(self):
+        while not self.stop_event.is_set():
+            due = self.database.next_due_posts(time.time())
+            if due is None:
+                return
+            self.post(*due)
+
+    # Posts a spin to each of its destinations that's due. entries are (id, destination, attempts, enqueued_at).
+    def post(self, song, entries):
+        try:
+            with metrics.timer("prepare_post", station=self.station_name):
+                prepared = self.prepare_post(song)
+        except Exception as e:
+            # Nothing can be posted without it, so it's a failed attempt for every destination
+            for entry in entries:
+                self.failed(song, entry, e)
+            return
+        with metrics.timer("post", station=self.station_name):
+            if len(entries) == 1:
+                self.post_to(song, prepared, entries[0])
+            else:
+                for future in [self.executor.submit(self.post_to, song, prepared, entry) for entry in entries]:
+                    future.result()
+
+    # Posts to one destination & records how it went. Never raises, so one bad instance can't affect the others.
+    def post_to(self, song, prepared, entry):
+        # Only load Mastodon.py once we actually have something to post
+        from mastodon import MastodonRatelimitError
+        outbox_id, destination, attempts, enqueued_at = entry
+        labels = {"station": self.station_name, "destination": destination}
+        try:
+            reset = self.rate_limit_reset(destination)
+            if reset is not None:
+                # Out of requests on this instance. Try again when the window resets, without counting an attempt.
+                print(f"***** [{self.station_name}] Out of Mastodon requests{for_destination(destination)}, "
+                      f"waiting until {time.ctime(reset)}")
+                self.database.mark_retry(outbox_id, attempts, reset, "rate limited")
+                return
+            with metrics.timer("post_destination", **labels):
+                self.send_post(prepared, destination)
+        except MastodonRatelimitError:
+            metrics.increment("kuvo_post_failures_total", reason="rate_limited", **labels)
+            # Not the post's fault, so don't count it as an attempt. Try again when the window resets.
+            reset = getattr(self.get_client(destination), "ratelimit_reset", None) or time.time() + base_retry_delay
+            print(f"***** [{self.station_name}] Rate limited{for_destination(destination)}, retrying {song['s']} at {time.ctime(reset)}")
+            self.database.mark_retry(outbox_id, attempts, reset, "rate limited")
+            return
+        except Exception as e:
+            self.failed(song, entry, e)
+            return
+        self.database.mark_posted(outbox_id)
+        metrics.increment("kuvo_posts_total", **labels)
+        metrics.observe("kuvo_scrape_to_post_seconds", time.time() - enqueued_at, **labels)
+
+    # Counts a failed attempt, & either schedules a retry with backoff or gives up
+    def failed(self, song, entry, error):
+        outbox_id, destination, attempts, enqueued_at = entry
+        metrics.increment("kuvo_post_failures_total", station=self.station_name, destination=destination, reason="error")
+        attempts += 1
+        if attempts >= self.max_attempts:
+            print(f"***** [{self.station_name}] Giving up on {song['s']} by {song['a']}{for_destination(destination)} "
+                  f"after {attempts} attempts: {error}")
+            self.database.mark_failed(outbox_id, attempts, str(error))
+        else:
+            delay = retry_delay(attempts)
+            print(f"***** [{self.station_name}] Post{for_destination(destination)} failed ({error}), retrying in {delay}s")
+            self.database.mark_retry(outbox_id, attempts, time.time() + delay, str(error))
+
+    # When the destination's rate limit window resets, if the last response said we have no requests left
+    def rate_limit_reset(self, destination):
+        client = self.get_client(destination)
+        remaining = getattr(client, "ratelimit_remaining", None)
+        reset = getattr(client, "ratelimit_reset", None)
+        if remaining is not None and reset is not None and remaining <= 0 and reset > time.time():
+            return reset
+        return None
+
+    # Posts whatever is due & then exits, giving up after timeout seconds. Used when a cron run ends.
+    def finish(self, timeout):
+        self.finishing = True
+        self.wake()
+        self.join(timeout)
+        self.stop()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake()
+
+
+# " to <destination>" for log lines, or nothing for the station's own account
+def for_destination(destination):
+    return f" to {destination}" if destination else ""
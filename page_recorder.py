@@ -0,0 +1,105 @@
+#!/usr/bin/python
+
+# Records the playlist pages the poller fetches, so a day on air can be replayed later through the real scraping
+# & posting code (benchmarks/replay.py) without waiting for it in real time.
+#
+# Each station gets one gzipped JSON Lines file a day, <station>-YYYY-MM-DD.jsonl.gz, with a line per fetch:
+#   {"t": epoch seconds, "url": ..., "status": 200, "etag": ..., "last_modified": ..., "sha1": ..., "content": ...}
+# Most polls get the same page back, so the page itself is only written the first time its sha1 appears in a
+# file. Later fetches of it just carry the sha1, & a 304 has neither. Each line is its own gzip member, so a
+# file is readable up to the last line written even if the poller is killed mid-write.
+
+import os
+import json
+import gzip
+import base64
+import hashlib
+import threading
+from datetime import datetime
+
+
+# Shared recorders, one per (directory, station)
+recorders = {}
+recorders_lock = threading.Lock()
+
+
+class PageRecorder:
+    def __init__(self, directory, station_name):
+        self.directory = directory
+        self.station_name = station_name
+        self.lock = threading.Lock()
+        # The file we're writing & the sha1s of the pages already in it
+        self.path = None
+        self.written = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, fetched_at):
+        day = datetime.fromtimestamp(fetched_at).strftime("%Y-%m-%d")
+        return os.path.join(self.directory, f"{self.station_name}-{day}.jsonl.gz")
+
+    def record(self, url, response, fetched_at):
+        entry = {"t": round(fetched_at, 3), "url": url, "status": response.status_code,
+                 "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        content = response.content if response.status_code == 200 else None
+        with self.lock:
+            path = self.path_for(fetched_at)
+            if path != self.path:
+                # A new day, or a restart partway through one
+                self.path = path
+                self.written = pages_in(path)
+            if content is not None:
+                entry["sha1"] = hashlib.sha1(content).hexdigest()
+                if entry["sha1"] not in self.written:
+                    self.written.add(entry["sha1"])
+                    try:
+                        entry["content"] = content.decode("utf-8")
+                    except UnicodeDecodeError:
+                        entry["content_b64"] = base64.b64encode(content).decode("ascii")
+            with gzip.open(path, "at", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+
+
+# The raw lines of one recording, as dicts. A line cut off by the poller being killed is skipped.
+def read_entries(path):
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            return
+
+
+# The sha1s of the pages written out in full in a recording so far
+def pages_in(path):
+    if not os.path.exists(path):
+        return set()
+    return {entry["sha1"] for entry in read_entries(path) if "content" in entry or "content_b64" in entry}
+
+
+# Every fetch in these recordings, oldest first, with "content" filled in as bytes for each 200. Several
+# stations' or days' files can be read together.
+def read_recordings(paths):
+    pages = {}
+    entries = []
+    for path in paths:
+        for entry in read_entries(path):
+            if "content" in entry:
+                pages[entry["sha1"]] = entry.pop("content").encode("utf-8")
+            elif "content_b64" in entry:
+                pages[entry["sha1"]] = base64.b64decode(entry.pop("content_b64"))
+            entries.append(entry)
+    entries.sort(key=lambda entry: entry["t"])
+    for entry in entries:
+        if entry.get("sha1") in pages:
+            entry["content"] = pages[entry["sha1"]]
+    return entries
+
+
+# Returns the shared recorder for a station, creating it the first time
+def open_recorder(directory, station_name):
+    key = (directory, station_name)
+    with recorders_lock:
+        if key not in recorders:
+            recorders[key] = PageRecorder(directory, station_name)
+        return recorders[key]
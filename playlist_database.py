@@ -0,0 +1,907 @@
+#!/usr/bin/python
+
+# The playlist database, shared by the poller & the playlist API.
+#
+# The poller holds one long-lived connection per database file in WAL mode, so API readers never block it
+# (and it never blocks them). The schema is versioned with PRAGMA user_version, and each migration
+# below runs once, in order, so an existing playlist.db upgrades in place the first time it's opened.
+#
+# Run this file with a database path to upgrade it by hand:
+#   python playlist_database.py playlist.db
+# to recount the play statistics from the playlist table:
+#   python playlist_database.py playlist.db rebuild-stats
+# or to convert an older database to the normalized schema (see normalize) & then reclaim the space:
+#   python playlist_database.py playlist.db normalize
+#   python playlist_database.py playlist.db vacuum
+# or to move closed years out into read-only archive files (see compact):
+#   python playlist_database.py playlist.db compact
+
+import re
+import os
+import sys
+import json
+import time
+import heapq
+import sqlite3
+import itertools
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from datetime import datetime, date, timedelta
+
+
+# Recomputes the play statistics from the playlist table. Used by migration 6 & the rebuild-stats command.
+# Days & hours come straight from the text of datetime_column ('YYYY-MM-DD HH:...').
+REBUILD_STATS = [
+    'DELETE FROM stats_artist_daily',
+    'DELETE FROM stats_album_daily',
+    'DELETE FROM stats_dj_daily',
+    'DELETE FROM stats_hourly',
+    '''INSERT INTO stats_artist_daily (day, artist, spins)
+       SELECT substr(datetime_column, 1, 10), artist, COUNT(*) FROM playlist WHERE artist != ''
+       GROUP BY 1, 2''',
+    '''INSERT INTO stats_album_daily (day, artist, album, spins)
+       SELECT substr(datetime_column, 1, 10), artist, album, COUNT(*) FROM playlist WHERE album != ''
+       GROUP BY 1, 2, 3''',
+    '''INSERT INTO stats_dj_daily (day, dj, spins)
+       SELECT substr(datetime_column, 1, 10), dj, COUNT(*) FROM playlist WHERE dj != ''
+       GROUP BY 1, 2''',
+    '''INSERT INTO stats_hourly (day, hour, spins)
+       SELECT substr(datetime_column, 1, 10), CAST(substr(datetime_column, 12, 2) AS INTEGER), COUNT(*) FROM playlist
+       GROUP BY 1, 2''',
+]
+
+# The counts REBUILD_STATS makes, as (query run on an archive, statement adding its rows to the main database's
+# stats tables), so archived years can be counted without attaching them
+ARCHIVE_STATS = [
+    ("SELECT substr(datetime_column, 1, 10), artist, COUNT(*) FROM playlist WHERE artist != '' GROUP BY 1, 2",
+     '''INSERT INTO stats_artist_daily (day, artist, spins) VALUES (?, ?, ?)
+        ON CONFLICT (day, artist) DO UPDATE SET spins = spins + excluded.spins'''),
+    ("SELECT substr(datetime_column, 1, 10), artist, album, COUNT(*) FROM playlist WHERE album != '' GROUP BY 1, 2, 3",
+     '''INSERT INTO stats_album_daily (day, artist, album, spins) VALUES (?, ?, ?, ?)
+        ON CONFLICT (day, artist, album) DO UPDATE SET spins = spins + excluded.spins'''),
+    ("SELECT substr(datetime_column, 1, 10), dj, COUNT(*) FROM playlist WHERE dj != '' GROUP BY 1, 2",
+     '''INSERT INTO stats_dj_daily (day, dj, spins) VALUES (?, ?, ?)
+        ON CONFLICT (day, dj) DO UPDATE SET spins = spins + excluded.spins'''),
+    ("SELECT substr(datetime_column, 1, 10), CAST(substr(datetime_column, 12, 2) AS INTEGER), COUNT(*)"
+     " FROM playlist GROUP BY 1, 2",
+     '''INSERT INTO stats_hourly (day, hour, spins) VALUES (?, ?, ?)
+        ON CONFLICT (day, hour) DO UPDATE SET spins = spins + excluded.spins'''),
+]
+
+# Each entry moves the schema up one version. Never edit one that has shipped; add a new one instead.
+MIGRATIONS = [
+    # 1: The original table, as the poller has always created it
+    [
+        '''CREATE TABLE IF NOT EXISTS playlist (
+                id INTEGER PRIMARY KEY,
+                datetime_column DATETIME,
+                playlist_id TEXT,
+                dj TEXT,
+                song TEXT,
+                artist TEXT,
+                album TEXT,
+                album_art TEXT
+                )''',
+    ],
+    # 2: Indexes. Older databases can hold the same playlist_id twice, so before adding the unique index
+    # we keep the first row as is & suffix the repeats with their row id rather than throwing plays away.
+    [
+        '''UPDATE playlist SET playlist_id = playlist_id || '#' || id
+           WHERE id NOT IN (SELECT MIN(id) FROM playlist GROUP BY playlist_id)''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS playlist_playlist_id ON playlist (playlist_id)',
+        'CREATE INDEX IF NOT EXISTS playlist_dj_datetime ON playlist (dj, datetime_column)',
+    ],
+    # 3: The outbox. The poller queues new spins here & the outbox worker posts them to Mastodon.
+    # status is 'pending', 'posted' or 'failed'. Times are epoch seconds.
+    [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                playlist_id TEXT,
+                song TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                enqueued_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                posted_at REAL,
+                last_error TEXT
+                )''',
+        'CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)',
+    ],
+    # 4: The poller's latest metrics snapshot, one row per Prometheus sample, for the API to serve
+    [
+        '''CREATE TABLE IF NOT EXISTS metrics (
+                name TEXT NOT NULL,
+                labels TEXT NOT NULL,
+                type TEXT NOT NULL,
+                value REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (name, labels)
+                )''',
+    ],
+    # 5: Full-text search over songs, artists & albums. The index reads its text from the playlist table
+    # (external content), so it adds no second copy of the strings. Triggers keep it in step with the table,
+    # and 'rebuild' indexes the rows that are already there.
+    [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS playlist_fts USING fts5(
+                song, artist, album,
+                content='playlist', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+                )''',
+        '''CREATE TRIGGER IF NOT EXISTS playlist_fts_insert AFTER INSERT ON playlist BEGIN
+                INSERT INTO playlist_fts (rowid, song, artist, album) VALUES (new.id, new.song, new.artist, new.album);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS playlist_fts_delete AFTER DELETE ON playlist BEGIN
+                INSERT INTO playlist_fts (playlist_fts, rowid, song, artist, album)
+                VALUES ('delete', old.id, old.song, old.artist, old.album);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS playlist_fts_update AFTER UPDATE ON playlist BEGIN
+                INSERT INTO playlist_fts (playlist_fts, rowid, song, artist, album)
+                VALUES ('delete', old.id, old.song, old.artist, old.album);
+                INSERT INTO playlist_fts (rowid, song, artist, album) VALUES (new.id, new.song, new.artist, new.album);
+           END''',
+        "INSERT INTO playlist_fts (playlist_fts) VALUES ('rebuild')",
+    ],
+    # 6: Daily play counts per artist, album, DJ & hour of the day, so the stats endpoints never scan the
+    # playlist. insert_songs keeps them up to date; they start off computed from the existing rows.
+    [
+        '''CREATE TABLE IF NOT EXISTS stats_artist_daily (
+                day TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                spins INTEGER NOT NULL,
+                PRIMARY KEY (day, artist)
+                )''',
+        '''CREATE TABLE IF NOT EXISTS stats_album_daily (
+                day TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                album TEXT NOT NULL,
+                spins INTEGER NOT NULL,
+                PRIMARY KEY (day, artist, album)
+                )''',
+        '''CREATE TABLE IF NOT EXISTS stats_dj_daily (
+                day TEXT NOT NULL,
+                dj TEXT NOT NULL,
+                spins INTEGER NOT NULL,
+                PRIMARY KEY (day, dj)
+                )''',
+        '''CREATE TABLE IF NOT EXISTS stats_hourly (
+                day TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                spins INTEGER NOT NULL,
+                PRIMARY KEY (day, hour)
+                )''',
+        *REBUILD_STATS,
+    ],
+    # 7: The normalized schema. DJs, artists, albums & art URLs are stored once each & spins refer to them by
+    # id, with played_at in epoch seconds. Existing rows move over with the normalize command; until then
+    # these tables stay empty & the playlist table is used as before.
+    [
+        'CREATE TABLE IF NOT EXISTS djs (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        'CREATE TABLE IF NOT EXISTS artists (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)',
+        '''CREATE TABLE IF NOT EXISTS albums (
+                id INTEGER PRIMARY KEY,
+                artist_id INTEGER NOT NULL REFERENCES artists (id),
+                title TEXT NOT NULL,
+                UNIQUE (artist_id, title)
+                )''',
+        'CREATE TABLE IF NOT EXISTS art_urls (id INTEGER PRIMARY KEY, url TEXT NOT NULL UNIQUE)',
+        '''CREATE TABLE IF NOT EXISTS spins (
+                id INTEGER PRIMARY KEY,
+                played_at INTEGER,
+                playlist_id TEXT UNIQUE,
+                dj_id INTEGER NOT NULL REFERENCES djs (id),
+                song TEXT,
+                artist_id INTEGER NOT NULL REFERENCES artists (id),
+                album_id INTEGER NOT NULL REFERENCES albums (id),
+                art_id INTEGER NOT NULL REFERENCES art_urls (id)
+                )''',
+        'CREATE INDEX IF NOT EXISTS spins_dj_played_at ON spins (dj_id, played_at)',
+        'CREATE INDEX IF NOT EXISTS spins_played_at ON spins (played_at)',
+    ],
+    # 8: What the album art lookup found for each (artist, album), keyed in lower case. mbid is NULL when it
+    # found nothing; looked_up_at (epoch seconds) says when, so "not found" can be retried later.
+    [
+        '''CREATE TABLE IF NOT EXISTS mbid_cache (
+                artist TEXT NOT NULL,
+                album TEXT NOT NULL,
+                mbid TEXT,
+                looked_up_at REAL NOT NULL,
+                PRIMARY KEY (artist, album)
+                )''',
+    ],
+    # 9: Fan-out. A spin is queued once per Mastodon destination, so each one is posted, retried & failed on
+    # its own. Rows queued before this are for the station's own account, destination ''.
+    [
+        "ALTER TABLE outbox ADD COLUMN destination TEXT NOT NULL DEFAULT ''",
+        'CREATE INDEX IF NOT EXISTS outbox_playlist_id ON outbox (playlist_id)',
+    ],
+]
+
+# Copies the playlist rows with ids in (?, ?] into the normalized tables, interning the strings first.
+# Old rows can have NULLs, which are stored as empty strings. Local times become epoch seconds.
+COPY_TO_SPINS = [
+    "INSERT OR IGNORE INTO djs (name) SELECT DISTINCT COALESCE(dj, '') FROM playlist WHERE id > ? AND id <= ?",
+    "INSERT OR IGNORE INTO artists (name) SELECT DISTINCT COALESCE(artist, '') FROM playlist WHERE id > ? AND id <= ?",
+    '''INSERT OR IGNORE INTO albums (artist_id, title)
+       SELECT DISTINCT artists.id, COALESCE(playlist.album, '') FROM playlist
+       JOIN artists ON artists.name = COALESCE(playlist.artist, '')
+       WHERE playlist.id > ? AND playlist.id <= ?''',
+    "INSERT OR IGNORE INTO art_urls (url) SELECT DISTINCT COALESCE(album_art, '') FROM playlist WHERE id > ? AND id <= ?",
+    '''INSERT OR IGNORE INTO spins (id, played_at, playlist_id, dj_id, song, artist_id, album_id, art_id)
+       SELECT playlist.id, CAST(strftime('%s', playlist.datetime_column, 'utc') AS INTEGER), playlist.playlist_id,
+              djs.id, playlist.song, artists.id, albums.id, art_urls.id
+       FROM playlist
+       JOIN djs ON djs.name = COALESCE(playlist.dj, '')
+       JOIN artists ON artists.name = COALESCE(playlist.artist, '')
+       JOIN albums ON albums.artist_id = artists.id AND albums.title = COALESCE(playlist.album, '')
+       JOIN art_urls ON art_urls.url = COALESCE(playlist.album_art, '')
+       WHERE playlist.id > ? AND playlist.id <= ?''',
+]
+
+# Swaps the playlist table for a view over the normalized tables, with the same columns (plus played_at),
+# so last_played.py & anything else reading or writing "playlist" keeps working. Inserts into the view are
+# interned by a trigger. Full-text search keeps reading through the view, so its index stays valid, but its
+# triggers move to spins.
+REPLACE_PLAYLIST_WITH_VIEW = [
+    'DROP TABLE playlist',
+    '''CREATE VIEW playlist AS
+       SELECT spins.id AS id,
+              datetime(spins.played_at, 'unixepoch', 'localtime') AS datetime_column,
+              spins.playlist_id AS playlist_id,
+              djs.name AS dj,
+              spins.song AS song,
+              artists.name AS artist,
+              albums.title AS album,
+              art_urls.url AS album_art,
+              spins.played_at AS played_at
+       FROM spins
+       JOIN djs ON djs.id = spins.dj_id
+       JOIN artists ON artists.id = spins.artist_id
+       JOIN albums ON albums.id = spins.album_id
+       JOIN art_urls ON art_urls.id = spins.art_id''',
+    '''CREATE TRIGGER playlist_insert INSTEAD OF INSERT ON playlist BEGIN
+            INSERT OR IGNORE INTO djs (name) VALUES (COALESCE(new.dj, ''));
+            INSERT OR IGNORE INTO artists (name) VALUES (COALESCE(new.artist, ''));
+            INSERT OR IGNORE INTO albums (artist_id, title)
+            VALUES ((SELECT id FROM artists WHERE name = COALESCE(new.artist, '')), COALESCE(new.album, ''));
+            INSERT OR IGNORE INTO art_urls (url) VALUES (COALESCE(new.album_art, ''));
+            INSERT OR IGNORE INTO spins (id, played_at, playlist_id, dj_id, song, artist_id, album_id, art_id)
+            VALUES (new.id,
+                    COALESCE(new.played_at, CAST(strftime('%s', new.datetime_column, 'utc') AS INTEGER)),
+                    new.playlist_id,
+                    (SELECT id FROM djs WHERE name = COALESCE(new.dj, '')),
+                    new.song,
+                    (SELECT id FROM artists WHERE name = COALESCE(new.artist, '')),
+                    (SELECT albums.id FROM albums JOIN artists ON artists.id = albums.artist_id
+                     WHERE artists.name = COALESCE(new.artist, '') AND albums.title = COALESCE(new.album, '')),
+                    (SELECT id FROM art_urls WHERE url = COALESCE(new.album_art, '')));
+       END''',
+    '''CREATE TRIGGER spins_fts_insert AFTER INSERT ON spins BEGIN
+            INSERT INTO playlist_fts (rowid, song, artist, album)
+            VALUES (new.id, new.song, (SELECT name FROM artists WHERE id = new.artist_id),
+                    (SELECT title FROM albums WHERE id = new.album_id));
+       END''',
+    '''CREATE TRIGGER spins_fts_delete AFTER DELETE ON spins BEGIN
+            INSERT INTO playlist_fts (playlist_fts, rowid, song, artist, album)
+            VALUES ('delete', old.id, old.song, (SELECT name FROM artists WHERE id = old.artist_id),
+                    (SELECT title FROM albums WHERE id = old.album_id));
+       END''',
+]
+
+# Rows to copy per transaction when normalizing, & how long to pause between batches so the poller gets a turn
+normalize_batch_size = 5000
+normalize_pause = 0.05
+
+# Copies one year of spins, with the DJs, artists, albums & art URLs they use, into an archive attached as
+# "archive". Ids are kept, so archives & the main database can be merged by id. Params are the year's
+# [start, end) in epoch seconds. The archive's own triggers fill in its search index.
+ARCHIVE_YEAR = [
+    '''INSERT INTO archive.djs (id, name) SELECT id, name FROM main.djs
+       WHERE id IN (SELECT dj_id FROM main.spins WHERE played_at >= :start AND played_at < :end)''',
+    '''INSERT INTO archive.artists (id, name) SELECT id, name FROM main.artists
+       WHERE id IN (SELECT artist_id FROM main.spins WHERE played_at >= :start AND played_at < :end)''',
+    '''INSERT INTO archive.albums (id, artist_id, title) SELECT id, artist_id, title FROM main.albums
+       WHERE id IN (SELECT album_id FROM main.spins WHERE played_at >= :start AND played_at < :end)''',
+    '''INSERT INTO archive.art_urls (id, url) SELECT id, url FROM main.art_urls
+       WHERE id IN (SELECT art_id FROM main.spins WHERE played_at >= :start AND played_at < :end)''',
+    '''INSERT INTO archive.spins (id, played_at, playlist_id, dj_id, song, artist_id, album_id, art_id)
+       SELECT id, played_at, playlist_id, dj_id, song, artist_id, album_id, art_id FROM main.spins
+       WHERE played_at >= :start AND played_at < :end ORDER BY id''',
+]
+
+# A year is closed, & can be archived, this many days into the next one, so late backfills still land in it
+archive_grace_days = 7
+# Spins to delete from the main database per transaction once they're archived
+archive_delete_batch_size = 5000
+
+# Adds one spin to each of the play statistics
+COUNT_STATS = [
+    ('''INSERT INTO stats_artist_daily (day, artist, spins) VALUES (:day, :artist, 1)
+        ON CONFLICT (day, artist) DO UPDATE SET spins = spins + 1''', ('artist',)),
+    ('''INSERT INTO stats_album_daily (day, artist, album, spins) VALUES (:day, :artist, :album, 1)
+        ON CONFLICT (day, artist, album) DO UPDATE SET spins = spins + 1''', ('album',)),
+    ('''INSERT INTO stats_dj_daily (day, dj, spins) VALUES (:day, :dj, 1)
+        ON CONFLICT (day, dj) DO UPDATE SET spins = spins + 1''', ('dj',)),
+    ('''INSERT INTO stats_hourly (day, hour, spins) VALUES (:day, :hour, 1)
+        ON CONFLICT (day, hour) DO UPDATE SET spins = spins + 1''', ()),
+]
+
+# Long-lived writers, one per database file
+databases = {}
+databases_lock = threading.Lock()
+
+
+# Brings the database up to the newest schema, one migration per transaction
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        print(f"***** Upgraded {database_name(conn)} to schema version {number}")
+
+
+def database_name(conn):
+    return conn.execute('PRAGMA database_list').fetchone()[2] or ':memory:'
+
+
+# The poller's side of the database: one connection, kept open, used from any polling thread
+class PlaylistDatabase:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        # isolation_level=None so we control transactions ourselves
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        # WAL lets the API read while we write. NORMAL is safe in WAL mode & saves an fsync per commit.
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('PRAGMA busy_timeout = 5000')
+        migrate(self.conn)
+        # A brand new database has nothing to convert, so it starts out normalized
+        if not is_normalized(self.conn) and self.conn.execute('SELECT 1 FROM playlist LIMIT 1').fetchone() is None:
+            normalize(self)
+
+    # Runs the body in one write transaction, rolling back if it raises
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    # Write playlist item into database, played now unless played_at says otherwise. Returns False if that
+    # playlist_id is already stored.
+    def insert_song(self, song, post=False, destinations=None, played_at=None):
+        return len(self.insert_songs([(song, played_at or datetime.now())], post, destinations)) == 1
+
+    # Which of these playlist IDs are already stored
+    def stored_ids(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+        placeholders = ", ".join("?" * len(ids))
+        with self.lock:
+            rows = self.conn.execute(f'SELECT playlist_id FROM playlist WHERE playlist_id IN ({placeholders})', ids).fetchall()
+        return {row[0] for row in rows}
+
+    # Writes a batch of (song, played_at) pairs in one transaction & returns the songs that were new.
+    # Songs already stored are skipped. With post=True the new ones also go into the outbox, in the same
+    # transaction, so a spin is never archived without being queued or queued without being archived.
+    # destinations(song) names the Mastodon destinations to queue a song for; without it there's just the one, ''.
+    def insert_songs(self, songs, post=False, destinations=None):
+        # Create Insert Statement
+        sql = '''INSERT OR IGNORE INTO playlist (datetime_column, playlist_id, dj, song, artist, album, album_art)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)'''
+        inserted = []
+        with self.transaction() as conn:
+            # Checked every time, since the normalize command can convert the database under a running poller
+            normalized = is_normalized(conn)
+            for song, played_at in songs:
+                row = song_row(song, played_at)
+                if normalized:
+                    # Inserts into the view don't report a row count, so look for the playlist_id first
+                    if conn.execute('SELECT 1 FROM spins WHERE playlist_id = ?', (row[1],)).fetchone() is not None:
+                        continue
+                    conn.execute(sql, row)
+                elif conn.execute(sql, row).rowcount != 1:
+                    continue
+                inserted.append(song)
+                count_stats(conn, row)
+            if post:
+                now = time.time()
+                conn.executemany('''INSERT INTO outbox (playlist_id, destination, song, enqueued_at, next_attempt_at)
+                                    VALUES (?, ?, ?, ?, ?)''',
+                                 [(song["i"], destination, json.dumps(song), now, now) for song in inserted
+                                  for destination in (destinations(song) if destinations else [''])])
+        return inserted
+
+    # When the most recent spins were stored, newest first, as datetimes. For one DJ (using the (dj, datetime_column)
+    # index) or, with dj=None, the whole station. The poll scheduler predicts track lengths from these.
+    def recent_spin_times(self, dj=None, limit=50):
+        with self.lock:
+            column = time_column(self.conn)
+            if dj is None:
+                rows = self.conn.execute(f'SELECT {column} FROM playlist ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+            else:
+                rows = self.conn.execute(f'''SELECT {column} FROM playlist WHERE dj = ?
+                                             ORDER BY {column} DESC LIMIT ?''', (dj.replace("\u200b", ""), limit)).fetchall()
+        if column == 'played_at':
+            return [datetime.fromtimestamp(row[0]) for row in rows]
+        return [datetime.fromisoformat(row[0]) for row in rows]
+
+    # The oldest spin with a post that's due, as (song, [(id, destination, attempts, enqueued_at), ...]) for
+    # each of its destinations that's due, or None
+    def next_due_posts(self, now):
+        with self.lock:
+            rows = self.conn.execute('''SELECT id, destination, song, attempts, enqueued_at FROM outbox
+                                        WHERE status = 'pending' AND next_attempt_at <= ? AND playlist_id =
+                                            (SELECT playlist_id FROM outbox
+                                             WHERE status = 'pending' AND next_attempt_at <= ?
+                                             ORDER BY id LIMIT 1)
+                                        ORDER BY id''', (now, now)).fetchall()
+        if not rows:
+            return None
+        return json.loads(rows[0][2]), [(row[0], row[1], row[3], row[4]) for row in rows]
+
+    # When the next queued post is due, or None if the outbox is empty
+    def next_post_time(self):
+        with self.lock:
+            return self.conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+    def mark_posted(self, outbox_id):
+        with self.lock:
+            self.conn.execute("UPDATE outbox SET status = 'posted', posted_at = ?, last_error = NULL WHERE id = ?",
+                              (time.time(), outbox_id))
+
+    # Puts a post back in the queue to try again at next_attempt_at
+    def mark_retry(self, outbox_id, attempts, next_attempt_at, error):
+        with self.lock:
+            self.conn.execute('UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?',
+                              (attempts, next_attempt_at, error, outbox_id))
+
+    # Gives up on a post. It stays in the table with its last error so it can be looked at or requeued by hand.
+    def mark_failed(self, outbox_id, attempts, error):
+        with self.lock:
+            self.conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                              (attempts, error, outbox_id))
+
+    # What the album art lookup last found for an album, as (mbid or None, looked_up_at), or None if it never looked
+    def cached_mbid(self, artist, album):
+        with self.lock:
+            return self.conn.execute('SELECT mbid, looked_up_at FROM mbid_cache WHERE artist = ? AND album = ?',
+                                     (artist, album)).fetchone()
+
+    def save_mbid(self, artist, album, mbid, looked_up_at):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO mbid_cache (artist, album, mbid, looked_up_at) VALUES (?, ?, ?, ?)',
+                              (artist, album, mbid, looked_up_at))
+
+    # Replaces the saved metrics with this snapshot of (name, labels, type, value) samples
+    def save_metrics(self, samples):
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM metrics')
+            conn.executemany('INSERT INTO metrics (name, labels, type, value, updated_at) VALUES (?, ?, ?, ?, ?)',
+                             [(name, labels, metric_type, value, now) for name, labels, metric_type, value in samples])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# The values we store for a scraped song, in the column order of the insert
+def song_row(song, played_at):
+    return (played_at.isoformat(" "), song["i"], song['dj'].replace("\u200b", ""), song['s'], song['a'], song['r'], song['image'])
+
+
+# Whether playlist is the view over the normalized tables, rather than the original table
+def is_normalized(conn):
+    row = conn.execute("SELECT type FROM sqlite_master WHERE name = 'playlist'").fetchone()
+    return row is not None and row[0] == 'view'
+
+
+# The indexed column to filter & sort spins by time: epoch seconds once normalized, the datetime text before
+def time_column(conn):
+    return 'played_at' if is_normalized(conn) else 'datetime_column'
+
+
+# A datetime as a value to compare with time_column(conn)
+def time_value(conn, when):
+    if is_normalized(conn):
+        return int(when.timestamp())
+    return when.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Moves the rows of the original playlist table into the normalized tables & replaces the table with a view.
+# Rows are copied in id order, a batch per transaction, so the poller & the API carry on while it runs.
+# Spins the poller stores meanwhile go into the old table & are picked up by the last batch, which makes
+# the swap in the same transaction. Row ids are kept, so the search index & anything else keyed on id
+# stays valid. The file only shrinks after a VACUUM.
+def normalize(database, batch_size=None, pause=None):
+    batch_size = batch_size or normalize_batch_size
+    pause = normalize_pause if pause is None else pause
+    copied = 0
+    while True:
+        with database.transaction() as conn:
+            if is_normalized(conn):
+                return
+            last_id = conn.execute('SELECT MAX(id) FROM playlist').fetchone()[0] or 0
+            upper = min(last_id, copied + batch_size)
+            for statement in COPY_TO_SPINS:
+                conn.execute(statement, (copied, upper))
+            if upper == last_id:
+                for statement in REPLACE_PLAYLIST_WITH_VIEW:
+                    conn.execute(statement)
+        if upper == last_id:
+            print(f"***** Normalized {database.db_file}, {last_id} rows")
+            return
+        copied = upper
+        print(f"***** Normalizing {database.db_file}: {copied} of {last_id} rows")
+        time.sleep(pause)
+
+
+# Counts a newly stored row (as made by song_row) in the play statistics
+def count_stats(conn, row):
+    values = {"day": row[0][:10], "hour": int(row[0][11:13]), "dj": row[2], "artist": row[4], "album": row[5]}
+    for sql, required in COUNT_STATS:
+        if all(values[name] for name in required):
+            conn.execute(sql, values)
+
+
+# Throws the play statistics away & counts them again from the playlist table, in one transaction. Archived
+# years count too: each archive's counts are read on its own connection & added in, in the same transaction.
+def rebuild_stats(database):
+    with database.lock:
+        archives = open_archives(database.db_file)
+        try:
+            with database.transaction() as conn:
+                for statement in REBUILD_STATS:
+                    conn.execute(statement)
+                for archive in archives:
+                    for count, add in ARCHIVE_STATS:
+                        conn.executemany(add, archive.execute(count))
+        finally:
+            for archive in archives:
+                archive.close()
+
+
+# Where a database keeps a closed year once it's compacted: archive/<name>_<year>.db next to it. An archive
+# holds the same normalized tables, playlist view & search index as the database, with just that year's spins.
+def archive_path(db_file, year):
+    path = Path(db_file).absolute()
+    return path.parent / 'archive' / f'{path.stem}_{year}.db'
+
+
+# The years a database has archives for, oldest first
+def archive_years(db_file):
+    path = Path(db_file).absolute()
+    directory = path.parent / 'archive'
+    if not directory.is_dir():
+        return []
+    years = []
+    for archive in directory.glob(f'{path.stem}_*.db'):
+        year = archive.stem[len(path.stem) + 1:]
+        if len(year) == 4 and year.isdigit():
+            years.append(int(year))
+    return sorted(years)
+
+
+# A year's [start, end) in epoch seconds, local time like played_at
+def year_bounds(year):
+    return int(datetime(year, 1, 1).timestamp()), int(datetime(year + 1, 1, 1).timestamp())
+
+
+# Moves every closed year still in the main database into its own archive. The main database is left with the
+# current year (plus a week or so around New Year), so it stays small. Run vacuum afterwards to shrink the file.
+def compact(database, today=None):
+    today = today or date.today()
+    with database.lock:
+        if not is_normalized(database.conn):
+            raise ValueError(f"{database.db_file} isn't normalized yet. Run the normalize command first.")
+        oldest = database.conn.execute('SELECT MIN(played_at) FROM spins').fetchone()[0]
+    if oldest is None:
+        return
+    last_closed = today.year - 1 if (today - date(today.year, 1, 1)).days >= archive_grace_days else today.year - 2
+    for year in range(datetime.fromtimestamp(oldest).year, last_closed + 1):
+        compact_year(database, year)
+
+
+# Archives one year: builds the archive file if there isn't one yet, then deletes the spins it holds from the
+# main database. The archive is written as a .part file, vacuumed, switched out of WAL mode (a read-only file
+# can't have a -wal alongside it), made read-only & only then renamed into place, so a crash never leaves a
+# half-built archive, & spins are only deleted once they're safely in one.
+def compact_year(database, year):
+    start, end = year_bounds(year)
+    bounds = {"start": start, "end": end}
+    path = archive_path(database.db_file, year)
+    with database.lock:
+        count = database.conn.execute('SELECT COUNT(*) FROM spins WHERE played_at >= :start AND played_at < :end',
+                                      bounds).fetchone()[0]
+    if count == 0:
+        return
+    if not path.exists():
+        path.parent.mkdir(exist_ok=True)
+        part = path.with_name(path.name + '.part')
+        if part.exists():
+            part.unlink()
+        # A fresh PlaylistDatabase creates the schema, already normalized
+        PlaylistDatabase(str(part)).close()
+        with database.lock:
+            database.conn.execute('ATTACH DATABASE ? AS archive', (str(part),))
+            try:
+                with database.transaction() as conn:
+                    for statement in ARCHIVE_YEAR:
+                        conn.execute(statement, bounds)
+            finally:
+                database.conn.execute('DETACH DATABASE archive')
+        archive = sqlite3.connect(str(part), isolation_level=None)
+        try:
+            archive.execute("INSERT INTO playlist_fts (playlist_fts) VALUES ('optimize')")
+            archive.execute('PRAGMA journal_mode = DELETE')
+            archive.execute('VACUUM')
+        finally:
+            archive.close()
+        os.chmod(part, 0o444)
+        os.replace(part, path)
+        print(f"***** Archived {count} spins from {year} to {path}")
+    # Delete what the archive holds, a batch at a time so the poller gets a turn. Anything stored for that year
+    # after the archive was built stays in the main database, where queries still find it.
+    deleted = 0
+    while True:
+        with database.lock:
+            database.conn.execute('ATTACH DATABASE ? AS archive', (str(path),))
+            try:
+                with database.transaction() as conn:
+                    removed = conn.execute('''DELETE FROM main.spins WHERE id IN
+                                              (SELECT id FROM main.spins
+                                               WHERE played_at >= :start AND played_at < :end
+                                               AND id IN (SELECT id FROM archive.spins) LIMIT :limit)''',
+                                           dict(bounds, limit=archive_delete_batch_size)).rowcount
+            finally:
+                database.conn.execute('DETACH DATABASE archive')
+        deleted += removed
+        if removed < archive_delete_batch_size:
+            break
+        time.sleep(normalize_pause)
+    print(f"***** Removed {deleted} archived spins from {year} from {database.db_file}")
+
+
+# Returns the shared writer for this database file, opening (& migrating) it the first time
+def open_database(db_file):
+    with databases_lock:
+        if db_file not in databases:
+            databases[db_file] = PlaylistDatabase(db_file)
+        return databases[db_file]
+
+
+# Closes every writer we opened, e.g. when the daemon shuts down
+def close_databases():
+    with databases_lock:
+        for database in databases.values():
+            database.close()
+        databases.clear()
+
+
+# A read-only connection for the API. It can't take the write lock, so it never gets in the poller's way.
+def connect_reader(db_file):
+    conn = sqlite3.connect(Path(db_file).absolute().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+    conn.execute('PRAGMA busy_timeout = 5000')
+    return conn
+
+
+# Changes whenever another connection commits to the database. Only comparable between calls on the same connection.
+def data_version(conn):
+    return conn.execute('PRAGMA data_version').fetchone()[0]
+
+
+# The id of the newest spin, or 0 if there are none. It only changes when a spin is stored, unlike data_version,
+# which changes on any commit (outbox updates, metrics snapshots, MBID lookups), so the API's response cache
+# keys on it.
+def playlist_version(conn):
+    table = 'spins' if is_normalized(conn) else 'playlist'
+    return conn.execute(f'SELECT MAX(id) FROM {table}').fetchone()[0] or 0
+
+
+# Read-only connections to the archives for these years (every archive if years is None), oldest first, to pass
+# to export_rows & search_songs. Each archive is read on a connection of its own rather than attached to the
+# reader: SQLite attaches at most 10 databases to a connection, & a station archived for more than ten years has
+# more archives than that. The caller closes them. Queries that only take the main connection, like songs_by_dj
+# & latest_spin, only ever read the main database.
+def open_archives(db_file, years=None):
+    return [connect_reader(archive_path(db_file, year)) for year in archive_years(db_file)
+            if years is None or year in years]
+
+
+# The years a datetime range reaches into, for open_archives. Either end can be None for open-ended.
+def years_between(start=None, end=None):
+    if start is None and end is None:
+        return None
+    return range(start.year if start else 1, (end.year if end else 9999) + 1)
+
+
+# Every song a DJ played since the given datetime. Uses the (dj, datetime_column) index, or (dj_id, played_at)
+# once normalized.
+def songs_by_dj(conn, dj, since):
+    cursor = conn.execute(f'''
+        SELECT datetime_column, dj, song, artist, album
+        FROM playlist
+        WHERE dj = ? AND {time_column(conn)} >= ?
+    ''', (dj, time_value(conn, since)))
+    return cursor.fetchall()
+
+
+# The columns export_rows returns, in order
+export_columns = ('id', 'datetime', 'dj', 'song', 'artist', 'album', 'album_art')
+
+
+# A cursor over every spin matching the filters on one connection, in id order
+def export_query(conn, start, end, dj, artist, after_id, limit):
+    conditions = ['id > ?']
+    params = [after_id]
+    column = time_column(conn)
+    if start is not None:
+        conditions.append(f'{column} >= ?')
+        params.append(time_value(conn, start))
+    if end is not None:
+        conditions.append(f'{column} < ?')
+        params.append(time_value(conn, end))
+    if dj is not None:
+        conditions.append('dj = ?')
+        params.append(dj)
+    if artist is not None:
+        conditions.append('artist = ?')
+        params.append(artist)
+    sql = f'''SELECT id, datetime_column, dj, song, artist, album, album_art FROM playlist
+              WHERE {' AND '.join(conditions)} ORDER BY id'''
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return conn.execute(sql, params)
+
+
+# Every spin matching the filters, in id order, for streaming exports. Any filter can be None.
+# start & end are datetimes (end exclusive). Pass the last id you got as after_id to carry on where you left off.
+# With archive connections (see open_archives) the same query runs on each & the rows are merged by id as
+# they're read, so memory use stays flat.
+def export_rows(conn, start=None, end=None, dj=None, artist=None, after_id=0, limit=None, archives=()):
+    cursor = export_query(conn, start, end, dj, artist, after_id, limit)
+    if not archives:
+        return cursor
+    rows = heapq.merge(cursor, *(export_query(archive, start, end, dj, artist, after_id, limit) for archive in archives),
+                       key=lambda row: row[0])
+    if limit is not None:
+        rows = itertools.islice(rows, limit)
+    return rows
+
+
+# The columns search_songs can be limited to
+search_fields = ('song', 'artist', 'album')
+
+
+# Turns what someone typed into an FTS5 query: every word must match, each as a prefix, so "ming" finds Mingus.
+# Words are quoted so FTS5 operators & punctuation in the input are never treated as syntax.
+def fts_query(text, field=None):
+    terms = ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+    if not terms or field is None:
+        return terms
+    return f'{field} : ({terms})'
+
+
+# Spins whose song, artist or album match the search text, best match first (bm25), or newest first with
+# newest=True. Returns (id, datetime, dj, song, artist, album) rows. With archive connections (see open_archives)
+# each one's index is searched too, for its best limit + offset matches, & those are merged into the page asked
+# for. bm25 is scored per index, which is close enough to rank by.
+def search_songs(conn, text, field=None, newest=False, limit=50, offset=0, archives=()):
+    query = fts_query(text, field)
+    if not query:
+        return []
+    order = 'played DESC' if newest else 'rank, played DESC'
+    rows = []
+    for source in (conn, *archives):
+        rows += source.execute(f'''
+            SELECT playlist.id, playlist.datetime_column, playlist.dj, playlist.song, playlist.artist, playlist.album,
+                   fts.rank AS rank, playlist.{time_column(source)} AS played
+            FROM playlist_fts AS fts JOIN playlist ON playlist.id = fts.rowid
+            WHERE fts.playlist_fts MATCH ?
+            ORDER BY {order} LIMIT ?''', (query, limit + offset)).fetchall()
+    if archives:
+        # Both sorts are stable, so this is the same order as the SQL
+        rows.sort(key=lambda row: row[7], reverse=True)
+        if not newest:
+            rows.sort(key=lambda row: row[6])
+    return [row[:6] for row in rows[offset:offset + limit]]
+
+
+# How many days back each stats period reaches, counting today
+stats_periods = {'day': 1, 'week': 7, 'month': 30, 'year': 365}
+
+# What each top-N stat is counted by & which table holds it
+stats_tops = {
+    'top_artists': ('stats_artist_daily', ('artist',)),
+    'top_albums': ('stats_album_daily', ('artist', 'album')),
+    'top_djs': ('stats_dj_daily', ('dj',)),
+}
+
+
+def stats_since(period, today):
+    return (today - timedelta(days=stats_periods[period] - 1)).isoformat()
+
+
+# The most played artists, albums or DJs (see stats_tops) over a period, as (key columns..., spins) rows.
+# Reads only the daily stats tables, so it costs the same however big the playlist gets.
+def stats_top(conn, name, period, limit=10, today=None):
+    table, columns = stats_tops[name]
+    since = stats_since(period, today or date.today())
+    keys = ', '.join(columns)
+    cursor = conn.execute(f'''
+        SELECT {keys}, SUM(spins) AS total FROM {table}
+        WHERE day >= ?
+        GROUP BY {keys}
+        ORDER BY total DESC, {keys}
+        LIMIT ?
+    ''', (since, limit))
+    return cursor.fetchall()
+
+
+# Spins in each hour of the day over a period, as (hour, spins) rows
+def stats_hourly(conn, period, today=None):
+    since = stats_since(period, today or date.today())
+    return conn.execute('SELECT hour, SUM(spins) FROM stats_hourly WHERE day >= ? GROUP BY hour ORDER BY hour',
+                        (since,)).fetchall()
+
+
+# The newest spin as a dict with the export_columns keys, or None if there isn't one. The poller stores the
+# current song after any it backfilled, so the highest id is the one on air.
+def latest_spin(conn):
+    row = conn.execute('''SELECT id, datetime_column, dj, song, artist, album, album_art FROM playlist
+                          ORDER BY id DESC LIMIT 1''').fetchone()
+    if row is None:
+        return None
+    return dict(zip(export_columns, row))
+
+
+# When the poller last saved its metrics, or None if it never has
+def metrics_saved_at(conn):
+    return conn.execute('SELECT MAX(updated_at) FROM metrics').fetchone()[0]
+
+
+# The poller's last saved metrics, as (name, labels, type, value) samples
+def saved_metrics(conn):
+    return conn.execute('SELECT name, labels, type, value FROM metrics').fetchall()
+
+
+if __name__ == '__main__':
+    commands = ('rebuild-stats', 'normalize', 'vacuum', 'compact')
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] not in commands):
+        print(f"Usage: playlist_database.py playlist.db [{' | '.join(commands)}]")
+        sys.exit(2)
+    database = open_database(sys.argv[1])
+    command = sys.argv[2] if len(sys.argv) == 3 else None
+    if command == 'rebuild-stats':
+        rebuild_stats(database)
+        print(f"***** Rebuilt the play statistics in {sys.argv[1]}")
+    elif command == 'normalize':
+        normalize(database)
+    elif command == 'compact':
+        try:
+            compact(database)
+        except ValueError as e:
+            print(f"***** {e}")
+            sys.exit(1)
+    elif command == 'vacuum':
+        # Rewrites the whole file. Readers carry on, but the poller waits (& may miss a poll) until it's done.
+        size = Path(sys.argv[1]).stat().st_size
+        with database.lock:
+            database.conn.execute('VACUUM')
+        print(f"***** Vacuumed {sys.argv[1]}: {size} -> {Path(sys.argv[1]).stat().st_size} bytes")
+    close_databases()
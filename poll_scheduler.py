@@ -0,0 +1,152 @@
+#!/usr/bin/python
+
+# Adaptive poll scheduling from the play history.
+#
+# Polling every 60 / times_to_poll_per_minute seconds wastes most requests in the middle of a track, and still
+# adds up to a whole interval of lag after a change. The gaps between spins in the playlist table tell us
+# roughly how long a track runs, per DJ. So after a change we sleep until the shorter tracks would be ending,
+# poll densely until all but the longest would have ended, & then fall back to the fixed rate until the
+# next change.
+#
+# Run this file against a database to compare it with the fixed schedule on recorded history:
+#   python poll_scheduler.py playlist.db --days 30 --fixed 20
+
+import sys
+import random
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+
+
+# Gaps outside this range are breaks, off-air time or two spins caught in one poll, not track lengths
+min_gap_seconds = 30
+max_gap_seconds = 30 * 60
+
+# How many recent gaps to predict from, & how many a DJ needs before we trust their own history
+history_size = 50
+min_history = 5
+
+
+# The value below which this fraction of the sorted values fall
+def quantile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+# The gaps in seconds between consecutive spin times (datetimes, any order) that look like track lengths, sorted
+def spin_gaps(times):
+    times = sorted(times)
+    gaps = [(later - earlier).total_seconds() for earlier, later in zip(times, times[1:])]
+    return sorted(gap for gap in gaps if min_gap_seconds <= gap <= max_gap_seconds)
+
+
+class PollScheduler:
+    # fixed_interval is the old schedule, used when we have no history & once a track runs longer than expected.
+    # Polling every dense_interval starts at the dense_from quantile of recent gaps & ends at the dense_until
+    # quantile. Track lengths vary a lot, so dense polling only pays off if it isn't much faster than the fixed
+    # schedule. Check the numbers for your station with the simulation below.
+    def __init__(self, dense_interval, max_interval, fixed_interval, dense_from=0.1, dense_until=0.9):
+        self.dense_interval = dense_interval
+        self.max_interval = max_interval
+        self.fixed_interval = fixed_interval
+        self.dense_from = dense_from
+        self.dense_until = dense_until
+
+    @classmethod
+    def from_config(cls, config):
+        fixed_interval = 60 / config["times_to_poll_per_minute"]
+        return cls(config.get("dense_poll_seconds", 12), config.get("max_poll_seconds", 120), fixed_interval,
+                   config.get("dense_poll_from", 0.1), config.get("dense_poll_until", 0.9))
+
+    # Seconds to wait before the next poll, given how long ago we saw the last change & the sorted recent gaps
+    def interval(self, since_change, gaps):
+        if since_change is None or len(gaps) < min_history:
+            return self.fixed_interval
+        dense_start = quantile(gaps, self.dense_from)
+        if since_change < dense_start:
+            # Mid-track: sleep until the change could be near, in steps of at most max_interval
+            return max(self.dense_interval, min(dense_start - since_change, self.max_interval))
+        if since_change < quantile(gaps, self.dense_until):
+            return self.dense_interval
+        # A long track or a break. Don't hammer Spinitron until it ends.
+        return self.fixed_interval
+
+
+# Simulates polling over recorded spin times with a scheduler (or the fixed schedule if scheduler is None).
+# Returns (requests, lags in seconds from each spin to the poll that saw it).
+# Each DJ's gaps are learned as the simulation goes, so predictions only use history from before the spin.
+def simulate(spins, scheduler, fixed_interval):
+    requests = 0
+    lags = []
+    # The most recent gaps in the order they happened, per DJ & for the whole station
+    gaps_by_dj = {}
+    station_gaps = deque(maxlen=history_size)
+    last_spin_by_dj = {}
+    now = spins[0][0]
+    last_change = None
+    current_dj = None
+    index = 0
+    while index < len(spins):
+        requests += 1
+        # Everything that started since the last poll is seen now; the newest one is the song on the page
+        if spins[index][0] <= now:
+            while index < len(spins) and spins[index][0] <= now:
+                played_at, dj = spins[index]
+                lags.append((now - played_at).total_seconds())
+                previous = last_spin_by_dj.get(dj)
+                if previous is not None:
+                    gap = (played_at - previous).total_seconds()
+                    if min_gap_seconds <= gap <= max_gap_seconds:
+                        gaps_by_dj.setdefault(dj, deque(maxlen=history_size)).append(gap)
+                        station_gaps.append(gap)
+                last_spin_by_dj[dj] = played_at
+                current_dj = dj
+                index += 1
+            last_change = now
+        if scheduler is None:
+            interval = fixed_interval
+        else:
+            since_change = (now - last_change).total_seconds() if last_change else None
+            gaps = gaps_by_dj.get(current_dj, ())
+            interval = scheduler.interval(since_change, sorted(gaps if len(gaps) >= min_history else station_gaps))
+        now += timedelta(seconds=interval)
+    return requests, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare adaptive polling with the fixed schedule on recorded spins.")
+    parser.add_argument("database", help="A playlist.db to read spin times from")
+    parser.add_argument("--days", type=float, default=30, help="How much recent history to replay")
+    parser.add_argument("--fixed", type=float, default=20, help="The fixed poll interval in seconds")
+    parser.add_argument("--dense", type=float, default=12, help="Adaptive interval around the expected change, in seconds")
+    parser.add_argument("--max", type=float, default=120, help="Longest adaptive interval in seconds")
+    parser.add_argument("--resolution", type=float, default=20,
+                        help="Poll interval the history was recorded at. Each spin really started up to this long before its timestamp.")
+    args = parser.parse_args()
+
+    # Only the simulation reads a database. The poller imports this module & shouldn't load sqlite3 for it.
+    import sqlite3
+    conn = sqlite3.connect(args.database)
+    since = (datetime.now() - timedelta(days=args.days)).isoformat(" ")
+    rows = conn.execute('SELECT datetime_column, dj FROM playlist WHERE datetime_column >= ? ORDER BY datetime_column',
+                        (since,)).fetchall()
+    conn.close()
+    # The recorded times are when our poller saw each spin, so they sit on its old polling grid. Spread them back
+    # over the interval they could have started in, or the fixed schedule would line up with them & look perfect.
+    random.seed(1)
+    spins = sorted((datetime.fromisoformat(played_at) - timedelta(seconds=random.uniform(0, args.resolution)), dj)
+                   for played_at, dj in rows)
+    if len(spins) < 2:
+        print("Not enough spins to simulate.")
+        sys.exit(1)
+
+    scheduler = PollScheduler(args.dense, args.max, args.fixed)
+    print(f"{len(spins)} spins from {spins[0][0]:%Y-%m-%d %H:%M} to {spins[-1][0]:%Y-%m-%d %H:%M}")
+    print(f"{'schedule':10} {'requests':>10} {'median lag':>11} {'p90 lag':>9}")
+    for name, schedule in (("fixed", None), ("adaptive", scheduler)):
+        requests, lags = simulate(spins, schedule, args.fixed)
+        lags.sort()
+        print(f"{name:10} {requests:>10} {quantile(lags, 0.5):>10.1f}s {quantile(lags, 0.9):>8.1f}s")
+
+
+if __name__ == '__main__':
+    main()
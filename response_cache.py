@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# An in-process cache of the playlist API's responses.
+#
+# The playlist only changes when the poller stores a spin, every few minutes, so almost every request can be
+# answered from memory. Entries are keyed by endpoint & parameters and carry a strong ETag. The cache is
+# cleared when a new spin is stored. Each request reads the newest spin id (playlist_database.playlist_version)
+# & hands it to validate(), which clears the cache once, for every thread, the first time it goes up. The
+# poller's other writes (outbox updates, metrics snapshots) leave the cache alone.
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class CachedResponse:
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> CachedResponse, least recently used first
+        self.entries = OrderedDict()
+        # Bumped on every invalidation, so a response built from data read before it isn't stored after it
+        self.generation = 0
+        # The database & playlist version the entries were built from
+        self.source = None
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    # Clears the cache if the playlist in `source` (the database file) has moved on since any thread last
+    # looked, or if it's another database. A reader that started just before a spin was stored can still report
+    # the older version, so only a newer one counts. Returns the generation a response built now belongs to.
+    def validate(self, source, version):
+        with self.lock:
+            if source != self.source or version > self.version:
+                self.source = source
+                self.version = version
+                self.entries.clear()
+                self.generation += 1
+            return self.generation
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Stores an entry built from data read during `generation`. If the database changed since, it's returned
+    # to the caller but not kept.
+    def put(self, key, entry, generation):
+        with self.lock:
+            if generation != self.generation:
+                return entry
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return entry
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
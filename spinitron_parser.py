@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+# Pulls the current song out of a Spinitron playlist page.
+#
+# The page is big & we only need a few things near the top of it: the show title and the first
+# spin-item row (its data-spin JSON, the spin time & the album art). The fast parser reads the page
+# with an HTMLParser and stops as soon as it has those. If it can't find them, we fall back to the
+# original BeautifulSoup parse of the whole page. When catching up after missed polls we read every
+# spin-item on the page the same way.
+#
+# Run this file with saved playlist pages to check both parsers agree:
+#   python spinitron_parser.py page1.html page2.html
+
+import sys
+import json
+import re
+from datetime import datetime, timedelta
+from html.parser import HTMLParser
+
+
+# How much of the page to hand the fast parser at a time
+chunk_size = 16384
+
+
+# Works out when a spin happened from its formatted time, e.g. "12:11pm". The page only shows the time of day,
+# so a time more than a few minutes in the future must have been yesterday.
+def spin_datetime(formatted_time, now):
+    spin_time = datetime.strptime(formatted_time, "%I:%M%p").time()
+    played_at = datetime.combine(now.date(), spin_time)
+    if played_at > now + timedelta(minutes=5):
+        played_at -= timedelta(days=1)
+    return played_at
+
+
+# Function to fix the style of the time that the song played
+# example: changes "12:11 PM" to ""12:11pm"
+def format_time(time_str):
+    modified_time = time_str[:-3] + time_str[-3].replace(" ", "") + time_str[-2:].lower()
+    return modified_time
+
+
+# Returns True if the tag's class attribute contains class_name
+def has_class(attrs, class_name):
+    for name, value in attrs:
+        if name == 'class' and value and class_name in value.split():
+            return True
+    return False
+
+
+# Raised from inside the parser once we have everything, to stop reading the rest of the page
+class DoneParsing(Exception):
+    pass
+
+
+# Streams through the page collecting the show title & the spin-item rows, stopping after max_rows of them
+# (or reading the whole page if max_rows is None).
+# Text is collected the way BeautifulSoup's get_text(strip=True) does it: each text node stripped, then joined.
+class SpinParser(HTMLParser):
+    def __init__(self, max_rows=1):
+        super().__init__(convert_charrefs=True)
+        self.max_rows = max_rows
+        self.dj_text = None
+        # One dict per finished row: data_spin, time_text, has_art_cell & img_src
+        self.rows = []
+        self.row = None
+        # What we're collecting text for right now: "dj", "time" or None, and how deep we are in that tag
+        self.capturing = None
+        self.capture_tag = None
+        self.capture_depth = 0
+        self.captured = []
+        self.in_art_cell = False
+
+    def done(self):
+        return self.dj_text is not None and self.max_rows is not None and len(self.rows) >= self.max_rows
+
+    # True if we found the title & every row we found has everything build_song needs
+    def complete(self):
+        if self.dj_text is None or not self.rows:
+            return False
+        for row in self.rows:
+            if row["data_spin"] is None or row["time_text"] is None or not row["has_art_cell"]:
+                return False
+        return True
+
+    def start_capture(self, name, tag):
+        self.capturing = name
+        self.capture_tag = tag
+        self.capture_depth = 1
+        self.captured = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.capturing and tag == self.capture_tag:
+            self.capture_depth += 1
+        if tag == 'h3' and self.dj_text is None and not self.capturing and has_class(attrs, 'show-title'):
+            self.start_capture("dj", tag)
+        elif tag == 'tr' and self.row is None and not self.done() and has_class(attrs, 'spin-item'):
+            self.row = {"data_spin": dict(attrs).get('data-spin'), "time_text": None, "has_art_cell": False, "img_src": None}
+        elif self.row is not None and tag == 'td':
+            if self.row["time_text"] is None and not self.capturing and has_class(attrs, 'spin-time'):
+                self.start_capture("time", tag)
+            elif not self.row["has_art_cell"] and has_class(attrs, 'spin-art'):
+                self.row["has_art_cell"] = True
+                self.in_art_cell = True
+        elif self.in_art_cell and tag == 'img' and self.row["img_src"] is None:
+            self.row["img_src"] = dict(attrs).get('src') or ""
+
+    def handle_endtag(self, tag):
+        if self.capturing and tag == self.capture_tag:
+            self.capture_depth -= 1
+            if self.capture_depth == 0:
+                text = "".join(self.captured)
+                if self.capturing == "dj":
+                    self.dj_text = text
+                else:
+                    self.row["time_text"] = text
+                self.capturing = None
+        if self.row is not None and tag == 'td':
+            self.in_art_cell = False
+        if self.row is not None and tag == 'tr':
+            self.rows.append(self.row)
+            self.row = None
+        if self.done():
+            raise DoneParsing()
+
+    def handle_data(self, data):
+        if self.capturing:
+            text = data.strip()
+            if text:
+                self.captured.append(text)
+
+
+# Turns what we scraped into the song dict the rest of the bot uses.
+# Both parsers go through here so they can't drift apart.
+def build_song(data_spin, time_text, dj_text, img_src, album_art_size):
+    # Convert it to a dict
+    data_spin_item = json.loads(data_spin)
+    # Fix the style of the time the song was played
+    data_spin_item["time"] = format_time(time_text)
+    # Songs without an ID get one from the title & spin time, so the same song aired again later is a new spin
+    if data_spin_item["i"] is None:
+        data_spin_item["i"] = data_spin_item["s"] + " " + data_spin_item["time"]
+        print(f"***** No ID on the song, so I set the i value to {data_spin_item['i']}")
+    data_spin_item["dj"] = dj_text.title()
+    # Check if the "src" attribute exists. img_src is None when there's no <img> in the art cell at all.
+    if img_src:
+        # push album art link into data_spin_item and resize to size specified in config
+        data_spin_item["image"] = re.sub(
+            r'^(.*)/\d+x\d+(.*\.jpg)$',
+            r'\1/' + album_art_size + r'\2',
+            img_src
+        )
+    else:
+        data_spin_item["image"] = ""
+    # Check if there's generic art because there's no album image:
+    if data_spin_item["image"] in ("", "https://spinitron.com/static/pictures/placeholders/loudspeaker.svg"):
+        data_spin_item["image_status"] = "no image"
+    else:
+        data_spin_item["image_status"] = "image"
+    return data_spin_item
+
+
+# What we return when there's no spin-item on the page at all
+def song_not_found(dj_text):
+    data_spin_item = {"i": "notfound", "a": "artist_not_found", "s": "song_not_found", "r": "album_not_found"}
+    if dj_text is not None:
+        data_spin_item["dj"] = dj_text.title()
+    return data_spin_item
+
+
+# The fast path. Returns the songs on the page, newest first, or None if the page doesn't look the way we
+# expect so the caller can fall back to soup.
+def parse_songs_fast(content, album_art_size, max_rows=None):
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', errors='replace')
+    parser = SpinParser(max_rows)
+    try:
+        for start in range(0, len(content), chunk_size):
+            parser.feed(content[start:start + chunk_size])
+        parser.close()
+    except DoneParsing:
+        pass
+    if not parser.complete():
+        return None
+    return [build_song(row["data_spin"], row["time_text"], parser.dj_text, row["img_src"], album_art_size) for row in parser.rows]
+
+
+# The original parse: build a BeautifulSoup tree of the whole page.
+# Returns the DJ & the songs on the page, newest first.
+def parse_songs_soup(content, album_art_size, max_rows=None):
+    # Only the fallback needs bs4, so only load it when we get here
+    from bs4 import BeautifulSoup
+    # Parse the content using BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    # Find the DJ
+    dj_text = soup.find('h3', 'show-title').get_text(strip=True)
+    songs = []
+    # Find the <tr> tags with class "spin-item"
+    for spin_item in soup.find_all('tr', class_='spin-item', limit=max_rows):
+        # Uncomment to debug. This will print the scraped HTML section of the playlist so you can see what's going on
+        # print(spin_item)
+        # Pull the time the song was played out of the <td>
+        time_text = spin_item.find('td', class_='spin-time').get_text(strip=True)
+        # Get the image source
+        img_tag = spin_item.find('td', class_='spin-art').find('img')
+        img_src = None
+        if img_tag:
+            img_src = img_tag.get('src') or ""
+        songs.append(build_song(spin_item.get('data-spin'), time_text, dj_text, img_src, album_art_size))
+    return dj_text, songs
+
+
+def parse_current_song_fast(content, album_art_size):
+    songs = parse_songs_fast(content, album_art_size, max_rows=1)
+    return songs[0] if songs else None
+
+
+def parse_current_song_soup(content, album_art_size):
+    dj_text, songs = parse_songs_soup(content, album_art_size, max_rows=1)
+    # Check if the tag with class "spin-item" is found
+    if not songs:
+        return song_not_found(dj_text)
+    return songs[0]
+
+
+# Parse the current song, fast if we can
+def parse_current_song(content, album_art_size):
+    data_spin_item = parse_current_song_fast(content, album_art_size)
+    if data_spin_item is None:
+        print("***** Fast parser couldn't find the spin-item, falling back to BeautifulSoup")
+        data_spin_item = parse_current_song_soup(content, album_art_size)
+    return data_spin_item
+
+
+# Parse every song on the page, newest first, fast if we can
+def parse_all_songs(content, album_art_size):
+    songs = parse_songs_fast(content, album_art_size)
+    if songs is None:
+        print("***** Fast parser couldn't read the spin-items, falling back to BeautifulSoup")
+        dj_text, songs = parse_songs_soup(content, album_art_size)
+    return songs
+
+
+# Checks that both parsers return identical dicts for each saved page. Exits non-zero if any differ.
+def check_parity(file_paths, album_art_size="768x768"):
+    mismatches = 0
+    for file_path in file_paths:
+        with open(file_path, 'rb') as file:
+            content = file.read()
+        fast = [parse_current_song_fast(content, album_art_size), parse_songs_fast(content, album_art_size)]
+        soup = [parse_current_song_soup(content, album_art_size), parse_songs_soup(content, album_art_size)[1]]
+        if fast == soup:
+            print(f"ok        {file_path}")
+        else:
+            mismatches += 1
+            print(f"MISMATCH  {file_path}\n  fast: {fast}\n  soup: {soup}")
+    return mismatches
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: spinitron_parser.py page.html [page.html ...]")
+        sys.exit(2)
+    sys.exit(1 if check_parity(sys.argv[1:]) else 0)
@@ -1,4 +1,6 @@
 #!/bin/bash
 cd /home/pi/kuvo_playlist_mastodon/
-export FLASK_APP=kuvo_playlist_api.py
-/usr/bin/python3 -m flask run --host=0.0.0.0 --port=5000 > /home/pi/kuvo_playlist_mastodon/flask.log 2>&1
+export KUVO_DB_PATH=${KUVO_DB_PATH:-/home/pi/kuvo_playlist_mastodon/playlist.db}
+# Several worker processes with a pool of threads each. See gunicorn.conf.py for the settings.
+# `kill -HUP` the master process to reload gracefully.
+exec /usr/bin/python3 -m gunicorn -c gunicorn.conf.py kuvo_playlist_api:app >> /home/pi/kuvo_playlist_mastodon/flask.log 2>&1